@@ -1,22 +1,35 @@
 #! /usr/bin/env python
 
 import argparse
+import asyncio
 import json
+import threading
+import time
 
 import logzero
 from logzero import logger
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 
+from slacktui.api import close_clients, get_client
 from slacktui.channel import query_channels
 from slacktui.config import load_config
-from slacktui.database import (add_reaction, init_db, mark_channel_unread,
-                               remove_reaction, store_channels, store_message,
-                               store_users)
+from slacktui.database import (add_reaction, close_connections, configure_db,
+                               find_channel_id, init_db,
+                               load_member_channel_ids, mark_channel_unread,
+                               remove_reaction, run_maintenance,
+                               store_channels, store_message, store_users)
+from slacktui.prefetch import (DEFAULT_PREFETCH_MAX_BYTES,
+                               DEFAULT_PREFETCH_WORKERS, Prefetcher)
+from slacktui.sync import abackfill_channel
+from slacktui.thumbnails import get_thumbnail_cache, get_terminal_thumbnail_size
 from slacktui.user import query_users
+from slacktui.writer import WriteQueue
 
 app = None
 ws = None
+writer = None
+prefetcher = None
 
 
 def init(args):
@@ -45,25 +58,215 @@ def init_app(config):
     app = App(token=user_token)
 
 
+def log_flush(batch_size, latency, depth):
+    """
+    Report write queue flushes.
+    """
+    logger.debug(
+        f"Flushed {batch_size} writes in {latency * 1000:.1f} ms;"
+        f" {depth} writes queued."
+    )
+
+
+def run_maintenance_loop(workspace, interval, batch_size, stop_event):
+    """
+    Enforce the retention policy and reclaim free space every `interval`
+    seconds until `stop_event` is set.
+    """
+    while True:
+        try:
+            report = run_maintenance(workspace, batch_size=batch_size)
+            logger.info(
+                f"Maintenance deleted {report['deleted_messages']} messages"
+                f" and reclaimed {report['reclaimed_bytes']} bytes;"
+                f" deleted {report['deleted_partial_bytes']} bytes of"
+                " abandoned downloads."
+            )
+            if report["deleted_by_channel"]:
+                logger.debug(f"Deleted by channel: {report['deleted_by_channel']}")
+        except Exception:
+            logger.exception("Database maintenance failed.")
+        if stop_event.wait(interval):
+            break
+    close_connections()
+
+
+def resolve_channel_ids(workspace, channels):
+    """
+    Channel IDs for a list of channel names or IDs.
+    Without a list, all the channels the user can read.
+    """
+    if not channels:
+        return load_member_channel_ids(workspace)
+    channel_ids = []
+    for channel in channels:
+        channel_id = find_channel_id(workspace, channel.lstrip("#"))
+        channel_ids.append(channel_id or channel)
+    return channel_ids
+
+
+async def backfill(config, workspace, channel_ids, days, concurrency):
+    """
+    Backfill the history of channels, `concurrency` channels at a time.
+    Each channel's progress is checkpointed, so rerunning an interrupted
+    backfill resumes it.
+    """
+    queue = asyncio.Queue()
+    for channel_id in channel_ids:
+        queue.put_nowait(channel_id)
+    progress = {"channels": 0, "messages": 0, "failed": 0}
+    started = time.monotonic()
+
+    def report_page(channel_id, count):
+        progress["messages"] += count
+        logger.debug(f"Stored {count} messages for channel {channel_id}.")
+
+    async def backfill_worker():
+        while not queue.empty():
+            channel_id = queue.get_nowait()
+            try:
+                count = await abackfill_channel(
+                    config, workspace, channel_id, days, on_page=report_page
+                )
+            except Exception as ex:
+                progress["failed"] += 1
+                logger.warning(f"Could not backfill channel {channel_id}: {ex}")
+                continue
+            progress["channels"] += 1
+            elapsed = time.monotonic() - started
+            logger.info(
+                f"Backfilled {count} messages for channel {channel_id};"
+                f" {progress['channels'] + progress['failed']}/{len(channel_ids)}"
+                f" channels, {progress['messages']} messages,"
+                f" {progress['messages'] / elapsed:.1f} messages/s."
+            )
+
+    client = get_client(config)
+    try:
+        workers = [backfill_worker() for _ in range(concurrency)]
+        await asyncio.gather(*workers)
+    finally:
+        await client.aclose()
+    return progress
+
+
+def run_backfill(args, config):
+    """
+    Backfill channel history and report the totals.
+    """
+    channel_ids = resolve_channel_ids(args.workspace, args.channels)
+    logger.info(
+        f"Backfilling {args.days} days of history for {len(channel_ids)} channels."
+    )
+    started = time.monotonic()
+    try:
+        progress = asyncio.run(
+            backfill(config, args.workspace, channel_ids, args.days, args.concurrency)
+        )
+    finally:
+        logger.info(f"Web API stats: {get_client(config).stats()}")
+        close_clients()
+    logger.info(
+        f"Backfilled {progress['messages']} messages from {progress['channels']}"
+        f" channels in {time.monotonic() - started:.1f} s;"
+        f" {progress['failed']} channels failed."
+    )
+
+
 def main(args):
     global app
     global ws
+    global writer
+    global prefetcher
     config = load_config(args.workspace)
+    configure_db(args.workspace, config)
     init_db(args.workspace)
-    channels = query_channels(config)
-    store_channels(args.workspace, channels)
-    users = query_users(config)
-    store_users(args.workspace, users)
+    logger.info("Syncing channels and users.")
+    changed = store_channels(args.workspace, query_channels(config))
+    logger.info(f"{changed} channels added or changed.")
+    changed = store_users(args.workspace, query_users(config))
+    logger.info(f"{changed} users added or changed.")
+    if args.backfill:
+        run_backfill(args, config)
+        return
     app_token = config["oauth"]["app_token"]
     logger.info("Starting Socket-mode handler.")
     ws = args.workspace
-    SocketModeHandler(app, app_token).start()
+    db_config = config.get("database", {})
+    writer = WriteQueue(
+        ws,
+        max_size=db_config.get("write_queue_size", 10000),
+        batch_size=db_config.get("write_batch_size", 200),
+        flush_interval=db_config.get("write_flush_ms", 50) / 1000,
+        on_flush=log_flush,
+    )
+    writer.start()
+    files_config = config.get("files", {})
+    prefetcher = Prefetcher(
+        config,
+        ws,
+        workers=files_config.get("prefetch_workers", DEFAULT_PREFETCH_WORKERS),
+        max_bytes=files_config.get("prefetch_max_bytes", DEFAULT_PREFETCH_MAX_BYTES),
+        budget_interval=3600,
+        size=get_terminal_thumbnail_size(),
+        thumbnails=get_thumbnail_cache(ws),
+    )
+    prefetcher.start()
+    retention_config = config.get("retention", {})
+    stop_maintenance = threading.Event()
+    maintenance = threading.Thread(
+        target=run_maintenance_loop,
+        args=(
+            ws,
+            retention_config.get("interval_minutes", 60) * 60,
+            retention_config.get("batch_size", 500),
+            stop_maintenance,
+        ),
+        name="db-maintenance",
+        daemon=True,
+    )
+    maintenance.start()
+    try:
+        SocketModeHandler(app, app_token).start()
+    finally:
+        stop_maintenance.set()
+        prefetcher.stop()
+        logger.info(f"Prefetch stats: {prefetcher.stats()}")
+        logger.info("Flushing queued writes.")
+        writer.stop()
+        logger.info(f"Write queue stats: {writer.stats()}")
+        logger.info(f"Web API stats: {get_client(config).stats()}")
+        close_clients()
 
 
 # Initialize
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Store Slack events in local database")
     parser.add_argument("workspace", action="store", help="Slack Workspace")
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Backfill channel history instead of recording events",
+    )
+    parser.add_argument(
+        "--channel",
+        action="append",
+        dest="channels",
+        metavar="CHANNEL",
+        help="Channel name or ID to backfill (default: all readable channels)",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=30,
+        help="Days of history to backfill (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Channels to backfill at once (default: %(default)s)",
+    )
     args = parser.parse_args()
     init(args)
 
@@ -83,8 +286,10 @@ def handle_message_events(event, say):
     print(f"text:         {text}")
     print("")
     if channel_type in ("channel", "group", "im"):
-        store_message(ws, event)
-        mark_channel_unread(ws, channel)
+        writer.put(store_message, event)
+        writer.put(mark_channel_unread, channel)
+        if "files" in event:
+            prefetcher.add(event["files"])
 
 
 @app.event("reaction_added")
@@ -100,7 +305,7 @@ def handle_reaction_added_events(event):
     print("")
     if item_type == "message":
         # print(json.dumps(event, indent=4))
-        add_reaction(ws, event)
+        writer.put(add_reaction, event)
 
 
 @app.event("reaction_removed")
@@ -115,7 +320,7 @@ def handle_all(event, say):
     print(f"ts:             {ts}")
     print("")
     if item_type == "message":
-        remove_reaction(ws, event)
+        writer.put(remove_reaction, event)
 
 
 @app.event("file_shared")
@@ -1,17 +1,15 @@
 #! /usr/bin/env python
 
+import asyncio
 import datetime
-import io
 import json
 import os
-import unicodedata
-from hashlib import md5
+import shutil
+import time
 from itertools import zip_longest
 from pathlib import Path
 
-import emoji
-from PIL import Image
-from rich.emoji import Emoji
+from rich.markup import escape
 from textual import on, work
 from textual.app import App, ComposeResult
 from textual.containers import Container, Horizontal, Vertical
@@ -22,43 +20,31 @@ from textual.screen import ModalScreen
 from textual.widgets import (Button, Checkbox, Footer, Header, Input, Label,
                              ListItem, ListView, LoadingIndicator, Select,
                              Static, TextArea)
+from textual.worker import get_current_worker
 from textual_image.widget import Image as ImageWidget
 
 from slacktui.config import load_config
-from slacktui.database import (load_channels, load_emojis, load_file,
-                               load_messages, load_users, mark_channel_read,
-                               store_message)
-from slacktui.files import get_file_data
-from slacktui.messages import (get_history_for_channel, message_transform,
-                               post_message)
+from slacktui.database import (SEARCH_MARK_END, SEARCH_MARK_START,
+                               configure_db, find_channel_id, find_user_id,
+                               init_db, load_channel_seq, load_file,
+                               load_message_digests_between,
+                               load_message_digests_since, load_messages_by_ts,
+                               load_messages_page, make_search_query,
+                               mark_channel_read, pooled_connections,
+                               search_messages, ts_after)
+from slacktui.directory import get_directory
+from slacktui.emojis import get_emoji_index, load_emoji_table, resolve_emoji
+from slacktui.files import get_file_data, get_preview_data
+from slacktui.messages import message_transform, post_message
+from slacktui.prefetch import (DEFAULT_PREFETCH_MAX_BYTES,
+                               DEFAULT_PREFETCH_WORKERS, Prefetcher)
 from slacktui.reactions import add_reaction, remove_reaction
-from slacktui.text import format_text_item
+from slacktui.reconcile import diff_keyed
+from slacktui.sync import sync_channel_history
+from slacktui.text import render_message
+from slacktui.thumbnails import get_thumbnail_cache, get_thumbnail_size
 from slacktui.user import get_authenticated_user
-
-_REACTION_ALIASES = {
-    "+1": "thumbs_up",
-}
-
-
-def get_emoji_from_code(code):
-    if len(code) == 0:
-        return code
-    if code[0] != ":":
-        code = f":{code}"
-    if code[-1] != ":":
-        code = f"{code}:"
-    symbol = Emoji.replace(code)
-    if symbol != code:
-        return symbol
-    symbol = emoji.emojize(code, language="alias")
-    if symbol != code:
-        return symbol
-    try:
-        symbol = unicodedata.lookup(code[1:-1])
-        return symbol
-    except KeyError:
-        pass
-    return _REACTION_ALIASES.get(code, code)
+from slacktui.writer import WriteQueue
 
 
 class ReactionChoiceScreen(ModalScreen):
@@ -73,7 +59,7 @@ class ReactionChoiceScreen(ModalScreen):
         options = []
         with Vertical(id="reaction-choice-panel"):
             for short_code in self.short_codes:
-                symbol = get_emoji_from_code(short_code)
+                symbol = resolve_emoji(short_code)
                 options.append((f"{symbol} :{short_code}:", short_code))
             yield Select(options, id="reaction-select", allow_blank=False)
             with Horizontal(id="reaction-choice-button-bar"):
@@ -118,13 +104,18 @@ class ReactionScreen(ModalScreen):
         ("left", "prev", "Previous"),
     ]
 
+    page_size = 9
+    search_delay = 0.1
+    offset = 0
+    search_timer = None
+
     def compose(self):
-        emoji_info = load_emojis(self.app.workspace, "")
+        self.emoji_index = get_emoji_index(
+            self.app.workspace, self.app.authenticated_user_id
+        )
         with Vertical(id="reaction-panel"):
             yield Input(placeholder="search pattern", id="reaction-search")
-            for row in list(emoji_info)[:9]:
-                emoji_symbol = row["emoji"]
-                code = row["short_code"]
+            for code, emoji_symbol in self.emoji_index.page("", 0, self.page_size):
                 yield Container(
                     EmojiButton(emoji_symbol, emoji=emoji_symbol, code=code),
                     Label(code, classes="reaction-label"),
@@ -135,74 +126,42 @@ class ReactionScreen(ModalScreen):
         self.dismiss(None)
 
     def action_next(self):
-        buttons = self.query(EmojiButton)
-        labels = self.query(Label)
-        input = self.query_one("#reaction-search")
-        pattern = input.value
-        ref_code = ""
-        for button in reversed(buttons):
-            ref_code = button.code
-            if ref_code != "":
-                break
-        emoji_info = list(load_emojis(self.app.workspace, ref_code, fltr=pattern))
-        if len(emoji_info) == 0:
+        pattern = self.query_one("#reaction-search").value
+        offset = self.offset + self.page_size
+        if offset >= len(self.emoji_index.search(pattern)):
             return
-        for row, button, label in zip_longest(emoji_info, buttons, labels):
-            if row is not None:
-                emoji_symbol = row["emoji"]
-                code = row["short_code"]
-                button.disabled = False
-            else:
-                emoji_symbol = ""
-                code = ""
-                button.disabled = True
-            button.emoji = emoji_symbol
-            button.code = code
-            button.label = emoji_symbol
-            label.update(code)
+        self.show_page(pattern, offset)
 
     def action_prev(self):
-        buttons = self.query(EmojiButton)
-        labels = self.query(Label)
-        input = self.query_one("#reaction-search")
-        pattern = input.value
-        ref_code = ""
-        for button in buttons:
-            ref_code = button.code
-            if ref_code != "":
-                break
-        emoji_info = list(
-            load_emojis(self.app.workspace, ref_code, reverse=True, fltr=pattern)
-        )
-        if len(emoji_info) == 0:
+        if self.offset == 0:
             return
-        emoji_info.reverse()
-        for row, button, label in zip_longest(emoji_info, buttons, labels):
-            if row is not None:
-                emoji_symbol = row["emoji"]
-                code = row["short_code"]
-                button.disabled = False
-            else:
-                emoji_symbol = ""
-                code = ""
-                button.disabled = True
-            button.emoji = emoji_symbol
-            button.code = code
-            button.label = emoji_symbol
-            label.update(code)
+        pattern = self.query_one("#reaction-search").value
+        self.show_page(pattern, max(0, self.offset - self.page_size))
 
     def on_input_changed(self, event):
+        # Coalesce rapid keystrokes into one search once typing pauses.
+        if self.search_timer is not None:
+            self.search_timer.stop()
+        self.search_timer = self.set_timer(self.search_delay, self.search)
+
+    def search(self):
+        self.search_timer = None
+        pattern = self.query_one("#reaction-search").value
+        self.show_page(pattern, 0)
+
+    def show_page(self, pattern, offset):
+        self.offset = offset
         buttons = self.query(EmojiButton)
         labels = self.query(Label)
-        value = event.input.value
-        emoji_info = load_emojis(self.app.workspace, "", fltr=value)
+        emoji_info = self.emoji_index.page(pattern, offset, self.page_size)
         for row, button, label in zip_longest(emoji_info, buttons, labels):
             if row is not None:
-                emoji_symbol = row["emoji"]
-                code = row["short_code"]
+                code, emoji_symbol = row
+                button.disabled = False
             else:
                 emoji_symbol = ""
                 code = ""
+                button.disabled = True
             button.emoji = emoji_symbol
             button.code = code
             button.label = emoji_symbol
@@ -211,9 +170,134 @@ class ReactionScreen(ModalScreen):
     def on_button_pressed(self, event):
         button = event.button
         code = button.code
+        self.emoji_index.record_use(code)
         self.dismiss(code)
 
 
+class SearchResultItem(ListItem):
+    channel_id = None
+    ts = None
+
+    def __init__(self, *args, channel_id=None, ts=None, **kwds):
+        super().__init__(*args, **kwds)
+        self.channel_id = channel_id
+        self.ts = ts
+
+
+class SearchScreen(ModalScreen):
+    """
+    Full-text search over the local message archive.
+    Besides search words, a query accepts `in:#channel`, `from:@user`,
+    `after:YYYY-MM-DD` and `before:YYYY-MM-DD` filters.
+    """
+
+    BINDINGS = [
+        ("escape", "quit", "Close search"),
+    ]
+    page_size = 20
+    search_params = None
+    offset = 0
+    exhausted = True
+
+    def compose(self):
+        with Vertical(id="search-panel"):
+            yield Input(
+                placeholder="search words in:#channel from:@user after:YYYY-MM-DD",
+                id="search-input",
+            )
+            yield ListView(id="search-results")
+
+    def action_quit(self):
+        self.dismiss(None)
+
+    def parse_search_text(self, text):
+        workspace = self.app.workspace
+        params = {}
+        words = []
+        for word in text.split():
+            key, sep, value = word.partition(":")
+            if not sep or not value:
+                words.append(word)
+            elif key == "in":
+                params["channel_id"] = find_channel_id(workspace, value.lstrip("#"))
+                if params["channel_id"] is None:
+                    raise ValueError(f"Unknown channel: {value}")
+            elif key == "from":
+                params["user_id"] = find_user_id(workspace, value.lstrip("@"))
+                if params["user_id"] is None:
+                    raise ValueError(f"Unknown user: {value}")
+            elif key in ("after", "before"):
+                date = datetime.datetime.strptime(value, "%Y-%m-%d")
+                if key == "after":
+                    params["since"] = date.timestamp()
+                else:
+                    params["until"] = date.timestamp()
+            else:
+                words.append(word)
+        if len(words) == 0:
+            raise ValueError("Nothing to search for.")
+        params["query"] = make_search_query(" ".join(words))
+        return params
+
+    async def on_input_submitted(self, event):
+        listview = self.query_one("#search-results")
+        await listview.clear()
+        try:
+            self.search_params = self.parse_search_text(event.value)
+        except ValueError as ex:
+            self.notify(str(ex), severity="warning")
+            return
+        self.offset = 0
+        self.exhausted = False
+        await self.load_page()
+        if len(listview.children) > 0:
+            listview.index = 0
+        listview.focus()
+
+    async def load_page(self):
+        rows = list(
+            search_messages(
+                self.app.workspace,
+                limit=self.page_size,
+                offset=self.offset,
+                **self.search_params,
+            )
+        )
+        self.offset += len(rows)
+        self.exhausted = len(rows) < self.page_size
+        listview = self.query_one("#search-results")
+        await listview.extend(self.create_result_item(row) for row in rows)
+
+    def create_result_item(self, row):
+        formatted_time = datetime.datetime.fromtimestamp(float(row["ts"])).strftime(
+            "%Y-%m-%d %I:%M %p"
+        )
+        channel = row["channel"] or row["user"] or row["channel_id"]
+        snippet = (
+            escape(row["snippet"])
+            .replace(SEARCH_MARK_START, "[reverse]")
+            .replace(SEARCH_MARK_END, "[/reverse]")
+        )
+        user = escape(row["user"] or "")
+        header = f"[b]#{escape(channel)}[/b] @{user} {formatted_time}"
+        return SearchResultItem(
+            Static(f"{header}\n{snippet}", classes="search-result", markup=True),
+            channel_id=row["channel_id"],
+            ts=row["ts"],
+        )
+
+    async def on_list_view_highlighted(self, event):
+        listview = event.list_view
+        if self.exhausted or listview.index is None:
+            return
+        if listview.index == len(listview.children) - 1:
+            await self.load_page()
+
+    def on_list_view_selected(self, event):
+        item = event.item
+        self.dismiss((item.channel_id, item.ts))
+
+
 class ImageViewScreen(ModalScreen):
 
     BINDINGS = [
@@ -228,10 +312,9 @@ class ImageViewScreen(ModalScreen):
     def __init__(self, *args, files=None, **kwds):
         super().__init__(*args, **kwds)
         self.files = files
+        self.thumbnails = None
 
-    def make_image_widget(self, image_data):
-        buf = io.BytesIO(image_data)
-        pil_image = Image.open(buf)
+    def make_image_widget(self, pil_image):
         w, h = pil_image.size
         if w >= h:
             style_class = "image-widget-wide"
@@ -242,19 +325,68 @@ class ImageViewScreen(ModalScreen):
     def compose(self):
         yield LoadingIndicator(classes="image-widget")
 
-    def get_image_data(self, file_id):
-        file_info = load_file(self.app.workspace, file_id)
-        if file_info is None:
-            self.app.get_file_from_slack(file_id, callback=self.process_file)
+    def thumbnail_size(self):
+        return get_thumbnail_size(self.app.size.width, self.app.size.height)
+
+    def get_image_data(self, file):
+        if self.thumbnails is None:
+            self.thumbnails = get_thumbnail_cache(self.app.workspace)
+        size = self.thumbnail_size()
+        image = self.thumbnails.get(file["id"], size)
+        if image is None:
+            self.load_image(file, size)
         else:
-            self.process_file(file_info)
+            self.show_image(file["id"], image)
+        self.prefetch_neighbors(self.file_index, size)
 
-    def process_file(self, file_info):
+    def fetch_thumbnail(self, file, size):
+        """
+        Download a preview of an image if it is not cached and make a
+        thumbnail of it.  Call it from a worker thread.
+        """
+        on_progress = self.app.make_progress_reporter("Downloading image")
+        file_info = get_preview_data(
+            self.app.config, self.app.workspace, file, size, on_progress=on_progress
+        )
+        self.app.call_from_thread(setattr, self.app, "sub_title", "")
+        if file_info is None:
+            print(f"Could not retrieve file info for ID: {file['id']}.")
+            return None
+        return self.thumbnails.put(file["id"], size, file_info["data"])
+
+    @work(group="image-load", exclusive=True, thread=True)
+    @pooled_connections
+    def load_image(self, file, size):
+        image = self.fetch_thumbnail(file, size)
+        if image is not None:
+            self.app.call_from_thread(self.show_image, file["id"], image)
+
+    @work(group="image-prefetch", exclusive=True, thread=True)
+    @pooled_connections
+    def prefetch_neighbors(self, index, size):
+        """
+        Make thumbnails of the images before and after `index`.
+        """
+        worker = get_current_worker()
+        for neighbor in (index + 1, index - 1):
+            if worker.is_cancelled:
+                return
+            if not 0 <= neighbor < len(self.files):
+                continue
+            file = self.files[neighbor]
+            if file.get("mimetype") not in self.app.image_types:
+                continue
+            if self.thumbnails.get(file["id"], size) is None:
+                self.fetch_thumbnail(file, size)
+
+    def show_image(self, file_id, image):
+        file = self.files[self.file_index]
+        if file["id"] != file_id:
+            return
         self.query(".image-widget").remove()
         self.query(".image-caption").remove()
-        file_data = file_info["data"]
-        image_widget = self.make_image_widget(file_data)
-        title = file_info["title"]
+        image_widget = self.make_image_widget(image)
+        title = file.get("title") or file.get("name", "")
         caption = Label(title, classes="image-caption")
         self.mount(image_widget)
         self.mount(caption)
@@ -273,15 +405,7 @@ class ImageViewScreen(ModalScreen):
         self.query(".image-widget").refresh()
 
     def watch_file_index(self, new_index):
-        file_id = self.files[self.file_index]["id"]
-        self.get_image_data(file_id)
-
-
-def compute_message_digest(message):
-    cannonical = json.dumps(message, sort_keys=True)
-    hash = md5(cannonical.encode())
-    digest = hash.hexdigest()
-    return digest
+        self.get_image_data(self.files[self.file_index])
 
 
 class MessageListItem(ListItem):
@@ -290,11 +414,10 @@ class MessageListItem(ListItem):
     reactions = None
     digest = None
 
-    def __init__(self, *args, files=None, reactions=None, message=None, **kwds):
+    def __init__(self, *args, files=None, reactions=None, digest=None, **kwds):
         super().__init__(*args, **kwds)
         self.files = files
         self.reactions = reactions
-        digest = compute_message_digest(message)
         self.digest = digest
 
 
@@ -321,6 +444,7 @@ class SlackApp(App):
         ("shift+down", "scroll_bottom", "Scroll to bottom"),
         ("r", "react", "React to message"),
         ("R", "remove_reaction", "Remove a reaction."),
+        ("/", "search", "Search messages"),
     ]
     image_types = frozenset(["image/jpeg", "image/png", "image/gif"])
     history_sync_days = 7
@@ -328,6 +452,17 @@ class SlackApp(App):
     workspace = os.environ["SLACK_WORKSPACE"]
     config = None
     channel_id = None
+    message_seq = 0
+    channels_token = None
+    directory = None
+    message_page_size = 50
+    max_loaded_messages = 150
+    at_oldest = True
+    at_newest = True
+    page_lock = None
+    prefetcher = None
+    render_writer = None
+    pending_ts = None
     freeze_channel = False
 
     def compose(self) -> ComposeResult:
@@ -335,14 +470,10 @@ class SlackApp(App):
         Create child widgets for the app.
         """
         self.authenticated_user_id = get_authenticated_user(self.config)["user_id"]
+        self.directory = get_directory(self.workspace)
+        self.directory.refresh()
+        load_emoji_table(self.workspace)
         options = self.get_channel_options()
-        user_map = {}
-        for user_info in load_users(self.workspace):
-            user_id = user_info["id"]
-            username = user_info["name"]
-            display_name = user_info["display_name"]
-            user_map[user_id] = (username, display_name)
-        self.user_map = user_map
         yield Header()
         with Vertical():
             with Horizontal():
@@ -357,11 +488,33 @@ class SlackApp(App):
 
     def on_mount(self):
         self.refresh_timer = self.set_interval(
-            3, self.refresh_messages, name="sync-interval", pause=True
+            3, self.poll_messages, name="sync-interval", pause=True
         )
         self.channels_timer = self.set_interval(
             10, self.populate_channels, name="channels-interval", pause=False
         )
+        self.page_lock = asyncio.Lock()
+        listview = self.query_one("#messages")
+        self.watch(listview, "scroll_y", self.handle_messages_scrolled, init=False)
+        files_config = self.config.get("files", {})
+        self.prefetcher = Prefetcher(
+            self.config,
+            self.workspace,
+            workers=files_config.get("prefetch_workers", DEFAULT_PREFETCH_WORKERS),
+            max_bytes=files_config.get(
+                "prefetch_max_bytes", DEFAULT_PREFETCH_MAX_BYTES
+            ),
+            thumbnails=get_thumbnail_cache(self.workspace),
+        )
+        self.prefetcher.start()
+        # Rendered messages are cached from a writer thread, so a page of
+        # cache misses costs one transaction and never waits on the UI thread.
+        self.render_writer = WriteQueue(self.workspace, max_size=1000)
+        self.render_writer.start()
+
+    def on_unmount(self):
+        self.prefetcher.stop()
+        self.render_writer.stop(timeout=1)
 
     def action_toggle_dark(self) -> None:
         """An action to toggle dark mode."""
@@ -416,7 +569,61 @@ class SlackApp(App):
         screen.short_codes = short_codes
         self.push_screen(screen, callback=handle_reaction_choice)
 
-    def action_scroll_bottom(self):
+    def action_search(self):
+
+        def handle_search_result(result):
+            if result is not None:
+                channel_id, ts = result
+                self.run_worker(self.jump_to_message(channel_id, ts))
+
+        self.push_screen(SearchScreen(), callback=handle_search_result)
+
+    async def jump_to_message(self, channel_id, ts):
+        """
+        Switch to a channel and select one of its messages.
+        """
+        if channel_id == self.channel_id:
+            await self.scroll_to_message(ts)
+            return
+        channel = self.directory.get_channel(channel_id)
+        if channel is None or not (channel.is_channel or channel.is_im):
+            self.notify("That conversation is not available here.")
+            return
+        is_dm = bool(channel.is_im)
+        options = self.get_channel_options(is_dm=is_dm)
+        # DMs with deleted users and bots are not listed, so they cannot be
+        # selected even though search finds their messages.
+        if channel_id not in (value for _, value in options):
+            self.notify("That conversation is not available here.")
+            return
+        dm_checkbox = self.query_one("#dm-checkbox")
+        unread_checkbox = self.query_one("#unread-checkbox")
+        with dm_checkbox.prevent(Checkbox.Changed):
+            dm_checkbox.value = is_dm
+        with unread_checkbox.prevent(Checkbox.Changed):
+            unread_checkbox.value = False
+        channel_select = self.query_one("#channel-select")
+        with channel_select.prevent(Select.Changed):
+            channel_select.set_options(options)
+        self.pending_ts = ts
+        channel_select.value = channel_id
+
+    async def scroll_to_message(self, ts):
+        listview = self.query_one("#messages")
+        widget_id = ts2id(ts)
+        for n, child in enumerate(listview.children):
+            if child.id == widget_id:
+                listview.index = n
+                listview.scroll_to_widget(child)
+                return
+        await self.show_message_window(ts)
+
+    async def action_scroll_bottom(self):
+        if not self.at_newest:
+            await self.show_message_window(None)
+        self.scroll_messages_to_bottom()
+
+    def scroll_messages_to_bottom(self):
         listview = self.query_one("#messages")
         children = listview.children
         if len(children) == 0:
@@ -425,6 +632,158 @@ class SlackApp(App):
         listview.scroll_to_widget(child)
         listview.index = len(children) - 1
 
+    def create_message_list_items(self, rows):
+        return [
+            self.create_message_list_item(
+                message_transform(json.loads(m["json_blob"])), m["digest"]
+            )
+            for m in rows
+        ]
+
+    def load_message_window(self, ts=None):
+        """
+        Load the newest page of the current channel, or a page centred on the
+        message at `ts`.
+        """
+        page_size = self.message_page_size
+        if ts is None:
+            rows = load_messages_page(self.workspace, self.channel_id, limit=page_size)
+            self.at_oldest = len(rows) < page_size
+            self.at_newest = True
+            return rows
+        half = page_size // 2
+        older = load_messages_page(
+            self.workspace, self.channel_id, before_ts=ts_after(ts), limit=half
+        )
+        newer = load_messages_page(
+            self.workspace, self.channel_id, after_ts=ts, limit=half
+        )
+        self.at_oldest = len(older) < half
+        self.at_newest = len(newer) < half
+        return older + newer
+
+    async def show_message_window(self, ts):
+        """
+        Replace the loaded messages with the window around `ts` (or the newest
+        page) and select that message.
+        """
+        listview = self.query_one("#messages")
+        async with self.page_lock:
+            await listview.clear()
+            rows = self.load_message_window(ts)
+            await listview.extend(self.create_message_list_items(rows))
+        self.call_after_refresh(self.queue_prefetch)
+        if ts is None:
+            self.scroll_messages_to_bottom()
+            return
+        widget_id = ts2id(ts)
+        for n, child in enumerate(listview.children):
+            if child.id == widget_id:
+                listview.index = n
+                listview.scroll_to_widget(child)
+                break
+
+    async def handle_messages_scrolled(self, scroll_y):
+        """
+        Page in older or newer messages when the message list is scrolled to
+        either end.
+        """
+        if self.page_lock.locked() or self.channel_id is None:
+            return
+        listview = self.query_one("#messages")
+        if scroll_y <= 0 and not self.at_oldest:
+            await self.load_older_messages()
+        elif scroll_y >= listview.max_scroll_y and not self.at_newest:
+            await self.load_newer_messages()
+        else:
+            return
+        self.call_after_refresh(self.queue_prefetch)
+
+    async def load_older_messages(self):
+        """
+        Prepend the page before the oldest loaded message and unmount pages
+        that are far below the viewport.
+        """
+        listview = self.query_one("#messages")
+        if len(listview.children) == 0:
+            return
+        async with self.page_lock:
+            first = listview.children[0]
+            rows = load_messages_page(
+                self.workspace,
+                self.channel_id,
+                before_ts=id2ts(first.id),
+                limit=self.message_page_size,
+            )
+            self.at_oldest = len(rows) < self.message_page_size
+            if len(rows) == 0:
+                return
+            index = listview.index
+            list_items = self.create_message_list_items(rows)
+            await listview.insert(0, list_items)
+            if index is not None:
+                index += len(list_items)
+            count = len(listview.children)
+            excess = count - self.max_loaded_messages
+            if excess > 0 and index is not None and index >= count - excess:
+                # Keep the highlight on screen rather than on an unmounted item.
+                index = len(list_items)
+            listview.index = index
+            self.call_after_refresh(
+                listview.scroll_to_widget, first, animate=False, top=True
+            )
+            if excess > 0:
+                await listview.remove_items(range(count - excess, count))
+                self.at_newest = False
+
+    async def load_newer_messages(self):
+        """
+        Append the page after the newest loaded message and unmount pages that
+        are far above the viewport.
+        """
+        listview = self.query_one("#messages")
+        if len(listview.children) == 0:
+            return
+        async with self.page_lock:
+            last = listview.children[-1]
+            rows = load_messages_page(
+                self.workspace,
+                self.channel_id,
+                after_ts=id2ts(last.id),
+                limit=self.message_page_size,
+            )
+            self.at_newest = len(rows) < self.message_page_size
+            if len(rows) == 0:
+                return
+            index = listview.index
+            await listview.extend(self.create_message_list_items(rows))
+            excess = len(listview.children) - self.max_loaded_messages
+            if excess > 0:
+                if index is not None and index < excess:
+                    # Keep the highlight on screen rather than on an unmounted
+                    # item.
+                    listview.index = listview.children.index(last)
+                await listview.remove_items(range(excess))
+                self.at_oldest = False
+            self.call_after_refresh(
+                listview.scroll_to_widget, last, animate=False, top=True
+            )
+
+    def queue_prefetch(self):
+        """
+        Queue the images of the loaded messages for prefetching, those on
+        screen first, then the rest newest first.
+        """
+        listview = self.query_one("#messages")
+        top = listview.scroll_y
+        bottom = top + listview.size.height
+        for child in reversed(listview.children):
+            if not child.files:
+                continue
+            y = child.virtual_region.y
+            visible = y + child.virtual_region.height > top and y < bottom
+            self.prefetcher.add(child.files, rank=0 if visible else 1)
+
     def action_view_images(self):
         listview = self.query_one("#messages")
         if listview.index is not None:
@@ -475,6 +834,16 @@ class SlackApp(App):
         unread_checkbox = self.query_one("#unread-checkbox")
         is_dm = dm_checkbox.value
         unread_only = unread_checkbox.value
+        self.directory.refresh()
+        token = (
+            self.directory.seq,
+            is_dm,
+            unread_only,
+            curr_value,
+        )
+        if token == self.channels_token:
+            return
+        self.channels_token = token
         options = self.get_channel_options(
             is_dm=is_dm, unread_only=unread_only, curr_value=curr_value
         )
@@ -494,13 +863,16 @@ class SlackApp(App):
 
     def get_channel_options(self, is_dm=False, unread_only=False, curr_value=None):
         options = []
-        for channel_id, name, user_id, read in load_channels(
-            self.workspace, load_dms=is_dm
-        ):
-            read = bool(read)
+        for channel in self.directory.list_channels(load_dms=is_dm):
+            channel_id = channel.id
+            name = channel.name
+            read = bool(channel.read)
             if is_dm:
-                username, display_name = self.user_map[user_id]
-                name = display_name
+                user = self.directory.get_user(channel.user_id)
+                if user is None:
+                    name = channel.user_id
+                else:
+                    name = user.display_name
             if unread_only and read and (channel_id != curr_value):
                 continue
             if (not read) and channel_id != curr_value:
@@ -511,8 +883,8 @@ class SlackApp(App):
         return options
 
     @on(Checkbox.Changed)
-    def handle_checkbox_changed(self, event):
-        self.populate_channels()
+    async def handle_checkbox_changed(self, event):
+        await self.populate_channels()
 
     @on(Select.Changed)
     async def handle_select(self, event):
@@ -522,6 +894,7 @@ class SlackApp(App):
         if self.freeze_channel:
             return
         self.refresh_timer.pause()
+        self.prefetcher.reset(get_thumbnail_size(self.size.width, self.size.height))
         listview = self.query_one("#messages")
         await listview.clear()
         if event.value == Select.BLANK:
@@ -529,22 +902,25 @@ class SlackApp(App):
             return
         self.channel_id = select.value
         mark_channel_read(self.workspace, self.channel_id)
-        messages = [
-            message_transform(json.loads(m["json_blob"]))
-            for m in load_messages(self.workspace, self.channel_id)
-        ]
-        list_items = []
-        for message in messages:
-            list_item = self.create_message_list_item(message)
-            list_items.append(list_item)
-            print(
-                f"APPENDED message with digets: {list_item.digest}:\n{json.dumps(message)}"
-            )
-        await listview.extend(list_items)
-        self.action_scroll_bottom()
+        self.message_seq = load_channel_seq(self.workspace, self.channel_id)
+        ts = self.pending_ts
+        self.pending_ts = None
+        await self.show_message_window(ts)
         self.sync_channel_history()
 
+    def poll_messages(self):
+        """
+        Start a refresh only when the current channel has changed since the
+        last one.
+        """
+        if self.channel_id is None:
+            return
+        if load_channel_seq(self.workspace, self.channel_id) <= self.message_seq:
+            return
+        self.refresh_messages()
+
     @work(group="refresh-messages", exclusive=True, thread=True)
+    @pooled_connections
     def refresh_messages(self):
         try:
             channel_select = self.query_one("#channel-select")
@@ -553,79 +929,191 @@ class SlackApp(App):
         channel = channel_select.value
         if channel == Select.BLANK:
             return
-        messages = list(
-            message_transform(json.loads(m["json_blob"]))
-            for m in load_messages(self.workspace, self.channel_id)
+        channel_id = self.channel_id
+        seq = self.message_seq
+        changed = load_message_digests_since(self.workspace, channel_id, seq)
+        if len(changed) == 0:
+            return
+        seq = max(row["seq"] for row in changed)
+        listview = self.query_one("#messages")
+        current = [(id2ts(li.id), li.digest) for li in listview.children]
+        # Messages older than the loaded window are paged in by scrolling, not
+        # mounted here.  The window is open ended at the newest message.
+        first_ts = None
+        last_ts = None
+        at_oldest = self.at_oldest
+        if current:
+            first_ts = current[0][0]
+            if any(row["ts"] < first_ts for row in changed):
+                at_oldest = False
+        if current and not self.at_newest:
+            last_ts = current[-1][0]
+        desired = [
+            (row["ts"], row["digest"])
+            for row in load_message_digests_between(
+                self.workspace, channel_id, first_ts, last_ts
+            )
+        ]
+        if len(desired) > self.max_loaded_messages:
+            # Keep the newest messages and unmount the oldest ones.
+            desired = desired[-self.max_loaded_messages :]
+            at_oldest = False
+        diff = diff_keyed(current, desired)
+        removed, changed, inserted = diff
+        timestamps = changed + [ts for _, run in inserted for ts in run]
+        messages = {}
+        for m in load_messages_by_ts(self.workspace, channel_id, timestamps):
+            message = message_transform(json.loads(m["json_blob"]))
+            messages[m["ts"]] = (message, m["digest"])
+        self.call_from_thread(
+            self.refresh_messages_ui,
+            channel_id,
+            current,
+            diff,
+            messages,
+            seq,
+            at_oldest,
         )
-        self.call_from_thread(self.refresh_messages_ui, messages)
 
-    async def refresh_messages_ui(self, messages):
-        listview = self.query_one("#messages")
-        orig_index = listview.index
-        listview.index = None
-        list_items = list(listview.children)
-        # if orig_index is None or orig_index == len(list_items) - 1:
-        #     self.app.set_timer(0.5, self.action_scroll_bottom)
-        if len(list_items) == 0:
-            # add all messages
-            print("No list items.  Adding all messages from DB.")
-            list_items = []
-            for message in messages:
-                list_item = self.create_message_list_item(message)
-                await listview.append(list_item)
-            self.action_scroll_bottom()
-            return
-        if len(messages) == 0:
-            print("No messages in DB.  Clearing list items.")
-            await listview.clear()
+    async def refresh_messages_ui(
+        self, channel_id, current, diff, messages, seq, at_oldest
+    ):
+        """
+        Reconcile the list view with the changes found by `refresh_messages`.
+        New items are mounted and stale ones removed in one batch, changed
+        items are updated in place, and the selection and scroll position
+        are kept.
+        """
+        if channel_id != self.channel_id:
             return
-        list_item_id_map = dict(
-            (id2ts(li.id), (n, li.digest)) for n, li in enumerate(list_items)
+        async with self.page_lock:
+            listview = self.query_one("#messages")
+            children = list(listview.children)
+            if [li.id for li in children] != [ts2id(ts) for ts, _ in current]:
+                # The window was paged since the diff was made; the next poll
+                # diffs it again.
+                return
+            self.message_seq = max(self.message_seq, seq)
+            self.at_oldest = at_oldest
+            removed, changed, inserted = diff
+            if not (removed or changed or inserted):
+                return
+            widgets = dict((id2ts(li.id), li) for li in children)
+            index = listview.index
+            selected = None
+            if index is not None and index < len(children):
+                selected = children[index]
+            at_bottom = index is None or index == len(children) - 1
+            anchor = None
+            for child in children:
+                if child.virtual_region.bottom > listview.scroll_y:
+                    anchor = child
+                    break
+            if anchor is not None:
+                anchor_offset = anchor.virtual_region.y - listview.scroll_y
+            stale = [widgets[ts] for ts in removed]
+            kept = [li for li in children if li not in stale]
+            replacements = {}
+            with self.batch_update():
+                mounts = []
+                for position, run in inserted:
+                    items = [
+                        self.create_message_list_item(*messages[ts])
+                        for ts in run
+                        if ts in messages
+                    ]
+                    if not items:
+                        continue
+                    if position < len(kept):
+                        mounts.append(listview.mount(*items, before=kept[position]))
+                    else:
+                        mounts.append(listview.mount(*items))
+                for ts in changed:
+                    if ts not in messages:
+                        continue
+                    item = widgets[ts]
+                    if self.update_message_list_item(item, *messages[ts]):
+                        continue
+                    # The attachments changed; rebuild the whole item.
+                    replacement = self.create_message_list_item(*messages[ts])
+                    mounts.append(listview.mount(replacement, before=item))
+                    replacements[item] = replacement
+                    stale.append(item)
+                for mount in mounts:
+                    await mount
+                if stale:
+                    await listview.remove_children(stale)
+            children = list(listview.children)
+            first_ts = id2ts(children[0].id) if children else ""
+            if at_bottom and self.at_newest:
+                self.scroll_messages_to_bottom()
+            else:
+                selected = replacements.get(selected, selected)
+                if selected in children:
+                    listview.index = children.index(selected)
+                elif selected is not None and id2ts(selected.id) < first_ts:
+                    # The highlighted message was unmounted with the oldest
+                    # ones; keep the highlight on screen.
+                    listview.index = 0
+                elif index is not None and children:
+                    listview.index = min(index, len(children) - 1)
+                anchor = replacements.get(anchor, anchor)
+                if anchor in children:
+                    self.call_after_refresh(
+                        self.restore_scroll, listview, anchor, anchor_offset
+                    )
+        self.call_after_refresh(self.queue_prefetch)
+
+    def restore_scroll(self, listview, anchor, offset):
+        """
+        Scroll so `anchor` is `offset` lines below the top of the list view
+        again.
+        """
+        listview.scroll_to(y=anchor.virtual_region.y - offset, animate=False)
+
+    def update_message_list_item(self, item, message, digest):
+        """
+        Update a message's text and reactions in place.
+        Return False if its attachments changed and it must be rebuilt.
+        """
+        files = message.get("files")
+        if [f["id"] for f in files or []] != [f["id"] for f in item.files or []]:
+            return False
+        reactions = message.get("reactions")
+        rendered = render_message(
+            self.workspace, message, digest, writer=self.render_writer
         )
-        list_item_ids = set(list_item_id_map.keys())
-        dbmsg_id_map = dict((m["ts"], m) for m in messages)
-        dbmsg_ids = set(dbmsg_id_map.keys())
-        # Remove items not in DB
-        not_in_db = list_item_ids - dbmsg_ids
-        indicies_to_remove = []
-        for index, list_item in enumerate(list_items):
-            ts = id2ts(list_item.id)
-            if ts in not_in_db:
-                await indicies_to_remove.append(index)
-        listview.remove_items(indicies_to_remove)
-        # Add messages not in list view
-        not_in_lv = dbmsg_ids - list_item_ids
-        for message in messages:
-            ts = message["ts"]
-            if ts in not_in_lv:
-                msg_list_item = self.create_message_list_item(message)
-                await listview.append(msg_list_item)
-        # Determine if any messages already in the list view changed.
-        same_ids = list_item_ids & dbmsg_ids
-        for shared_id in same_ids:
-            # Compute digest of DB message
-            message = dbmsg_id_map[shared_id]
-            computed_digest = compute_message_digest(message)
-            # Compare to digest of list item message
-            pos, stored_digest = list_item_id_map[shared_id]
-            if computed_digest != stored_digest:
-                # print("DIFF!!!")
-                # print(
-                #     f"stored digest: {stored_digest}\ncomputed digest: {computed_digest}"
-                # )
-                # print(f"DB message:\n{json.dumps(message)}")
-                # Insert new message and remove old message
-                msg_list_item = self.create_message_list_item(message)
-                await listview.pop(pos)
-                await listview.insert(pos, [msg_list_item])
-        if orig_index is None or orig_index == len(list_items) - 1:
-            self.action_scroll_bottom()
+        item.query_one(".message-text", Static).update(rendered["markup"])
+        summary = rendered["reactions"]
+        indicators = item.query(ReactionIndicator)
+        if summary is None:
+            indicators.remove()
+        elif indicators:
+            indicator = indicators.first()
+            indicator.update(summary["text"])
+            indicator.tooltip = summary["tooltip"]
+            indicator.reaction_data = reactions
         else:
-            listview.index = orig_index
+            status_bar = item.query_one(".msg-status-bar")
+            status_bar.mount(self.make_reactions_widget(summary, reactions))
+        item.files = files
+        item.reactions = reactions
+        item.digest = digest
+        return True
+
+    def make_reactions_widget(self, summary, reactions):
+        reactions_widget = ReactionIndicator(
+            summary["text"], reaction_data=reactions, classes="reactions"
+        )
+        reactions_widget.tooltip = summary["tooltip"]
+        return reactions_widget
 
-    def create_message_list_item(self, message):
+    def create_message_list_item(self, message, digest):
         ts = message["ts"]
-        username, user = self.user_map.get(message["user"], (None, None))
+        user = None
+        user_info = self.directory.get_user(message["user"])
+        if user_info is not None:
+            user = user_info.display_name
         files = message.get("files")
         formatted_time = datetime.datetime.fromtimestamp(float(ts)).strftime(
             "%Y-%m-%d %I:%M %p"
@@ -636,32 +1124,18 @@ class SlackApp(App):
             Label(formatted_time, classes="timestamp"),
         ]
         reactions = message.get("reactions")
-        if reactions is not None:
-            symbols = []
-            reaction_names = []
-            for reaction in reactions:
-                react_name = reaction["name"]
-                react_count = reaction["count"]
-                emoji_symbol = get_emoji_from_code(react_name)
-                symbols.append(f"{emoji_symbol}x{react_count}")
-                reaction_names.append(react_name)
-            react_str = " ".join(symbols)
-            tooltip = f"Reactions: {', '.join(reaction_names)}"
-            reactions_widget = ReactionIndicator(
-                react_str, reaction_data=reactions, classes="reactions"
-            )
-            reactions_widget.tooltip = tooltip
-            status_components.append(reactions_widget)
-            status_components
+        rendered = render_message(
+            self.workspace, message, digest, writer=self.render_writer
+        )
+        summary = rendered["reactions"]
+        if summary is not None:
+            status_components.append(self.make_reactions_widget(summary, reactions))
         msg_status_bar = Horizontal(
             *status_components,
             classes="msg-status-bar",
         )
         rows.append(msg_status_bar)
-        text = format_text_item(self.workspace, message)
-        # print(json.dumps(message, indent=4))
-        # print(text)
-        message_text = Static(text, classes="message-text", markup=True)
+        message_text = Static(rendered["markup"], classes="message-text", markup=True)
         rows.append(message_text)
         file_labels = []
         if files is not None:
@@ -678,52 +1152,55 @@ class SlackApp(App):
             files=files,
             reactions=reactions,
             id=ts2id(ts),
-            message=message,
+            digest=digest,
         )
         return list_item
 
     @work(group="sync-channel", thread=True)
+    @pooled_connections
     def sync_channel_history(self):
-        history = get_history_for_channel(
-            self.config, self.channel_id, self.history_sync_days
-        )
-        for message in history:
-            message["channel"] = self.channel_id
-            store_message(self.workspace, message)
-        print(
-            f"Database synced for {self.history_sync_days} days worth of messages "
-            f"for channel ID {self.channel_id}."
+        count = sync_channel_history(
+            self.config, self.workspace, self.channel_id, self.history_sync_days
         )
+        print(f"Synced {count} new messages for channel ID {self.channel_id}.")
         self.refresh_timer.resume()
 
-    @work(group="file-download", exclusive=True, thread=True)
-    def get_file_from_slack(self, file_id, callback=None):
-        file_info = get_file_data(self.config, self.workspace, file_id)
-        if file_info is None:
-            print(f"Could not retrieve file info for ID: {file_id}.")
-            return
-        print("Retrieved file data.")
-        if callback is not None:
-            self.call_from_thread(callback, file_info)
-
-    def process_file(self, file_info):
-        mimetype = file_info["mimetype"]
-        if mimetype in self.image_types:
-            file_data = file_info["data"]
-            screen = ImageViewScreen()
-            screen.image_data = file_data
-            self.push_screen(screen)
+    def make_progress_reporter(self, label):
+        """
+        Download progress callback that shows the progress in the header,
+        at most a few times a second.  Call it from a worker thread.
+        """
+        last_update = 0.0
+
+        def report(received, size):
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update < 0.25 and received != size:
+                return
+            last_update = now
+            if size:
+                text = f"{label}: {received * 100 // size}% of {size / 1e6:.1f} MB"
+            else:
+                text = f"{label}: {received / 1e6:.1f} MB"
+            self.call_from_thread(setattr, self, "sub_title", text)
+
+        return report
 
     @work(thread=True)
+    @pooled_connections
     def handle_dl_button_pressed(self, button):
         file_id = button.file_id
         print(f"Pressed download button with file ID: {file_id}")
-        file_info = get_file_data(self.config, self.workspace, file_id)
+        file_info = load_file(self.workspace, file_id)
+        if file_info is None:
+            on_progress = self.make_progress_reporter(f"Downloading {button.filename}")
+            file_info = get_file_data(
+                self.config, self.workspace, file_id, on_progress=on_progress
+            )
+            self.call_from_thread(setattr, self, "sub_title", "")
         if file_info is None:
             print(f"Could not retrieve file info for ID {file_id}.")
             return
-        print("Retrieved file data.")
-        file_data = file_info["data"]
         dl_folder = self.config.get("files", {}).get("download_folder", "~/Downloads")
         dl_folder = Path(dl_folder).expanduser()
         if not dl_folder.is_dir():
@@ -741,13 +1218,16 @@ class SlackApp(App):
                 )
                 return
             fname = dl_folder / Path(f"{filename.stem}.{n:03}{filename.suffix}")
-        with open(fname, "wb") as f:
-            f.write(file_data)
+        temp_name = fname.with_name(f".{fname.name}.part")
+        shutil.copyfile(file_info["path"], temp_name)
+        os.replace(temp_name, fname)
         print(f"File written to '{fname}'.")
 
 
 if __name__ == "__main__":
     app = SlackApp()
     config = load_config(app.workspace)
+    configure_db(app.workspace, config)
+    init_db(app.workspace)
     app.config = config
     app.run()
@@ -0,0 +1,157 @@
+import importlib.util
+
+import httpx
+
+from slacktui.ratelimit import BACKGROUND, RateLimiter
+
+DEFAULT_BASE_URL = "https://slack.com/api/"
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_MAX_CONNECTIONS = 10
+
+_clients = {}
+
+
+def http2_available():
+    """
+    True if the optional `h2` package httpx needs for HTTP/2 is installed.
+    """
+    return importlib.util.find_spec("h2") is not None
+
+
+def get_client(config):
+    """
+    The shared Web API client for the workspace `config` belongs to.
+    The optional `[api]` table of the config sets `base_url`, `timeout`,
+    `connect_timeout`, `max_connections` and `max_retries`.
+    """
+    user_token = config["oauth"]["user_token"]
+    client = _clients.get(user_token)
+    if client is None:
+        api_config = config.get("api", {})
+        client = SlackClient(
+            user_token,
+            base_url=api_config.get("base_url", DEFAULT_BASE_URL),
+            timeout=api_config.get("timeout", DEFAULT_TIMEOUT),
+            connect_timeout=api_config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+            max_connections=api_config.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+            rate_limiter=RateLimiter(max_retries=api_config.get("max_retries", 5)),
+        )
+        _clients[user_token] = client
+    return client
+
+
+def is_url(method):
+    """
+    True if `method` is an absolute URL rather than a Web API method name.
+    """
+    return method.startswith(("https://", "http://"))
+
+
+def close_clients():
+    """
+    Close the connection pools of all shared clients.
+    """
+    for client in _clients.values():
+        client.close()
+    _clients.clear()
+
+
+class SlackClient:
+    """
+    Keep-alive connection pools to the Slack Web API for one token.
+
+    Methods are addressed by name relative to `base_url`, e.g.
+    `client.get("conversations.history", params)`.  Absolute URLs, such as a
+    file's `url_private`, are fetched through the same pool.  The async
+    client is created on first use so it binds to the running event loop.
+    """
+
+    def __init__(
+        self,
+        token,
+        base_url=DEFAULT_BASE_URL,
+        timeout=DEFAULT_TIMEOUT,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        rate_limiter=None,
+    ):
+        if not base_url.endswith("/"):
+            base_url = f"{base_url}/"
+        self._settings = {
+            "base_url": base_url,
+            "headers": {"Authorization": f"Bearer {token}"},
+            "timeout": httpx.Timeout(timeout, connect=connect_timeout),
+            "limits": httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            "http2": http2_available(),
+        }
+        self.client = httpx.Client(**self._settings)
+        self._async_client = None
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(**self._settings)
+        return self._async_client
+
+    def get(self, method, params=None, priority=BACKGROUND):
+        return self.request("GET", method, params, priority)
+
+    def post(self, method, params=None, priority=BACKGROUND):
+        return self.request("POST", method, params, priority)
+
+    async def aget(self, method, params=None, priority=BACKGROUND):
+        return await self.arequest("GET", method, params, priority)
+
+    async def apost(self, method, params=None, priority=BACKGROUND):
+        return await self.arequest("POST", method, params, priority)
+
+    def request(self, http_method, method, params=None, priority=BACKGROUND):
+        if is_url(method):
+            return self.client.request(http_method, method, params=params)
+        attempt = 0
+        while True:
+            self.rate_limiter.wait(method, priority)
+            response = self.client.request(http_method, method, params=params)
+            if response.status_code != 429:
+                return response
+            attempt += 1
+            if not self.rate_limiter.throttle(method, response, attempt):
+                return response
+
+    async def arequest(self, http_method, method, params=None, priority=BACKGROUND):
+        client = self.async_client
+        if is_url(method):
+            return await client.request(http_method, method, params=params)
+        attempt = 0
+        while True:
+            await self.rate_limiter.async_wait(method, priority)
+            response = await client.request(http_method, method, params=params)
+            if response.status_code != 429:
+                return response
+            attempt += 1
+            if not self.rate_limiter.throttle(method, response, attempt):
+                return response
+
+    def stream(self, url, headers=None):
+        """
+        Context manager for a streamed GET of an absolute URL.
+        """
+        return self.client.stream("GET", url, headers=headers)
+
+    def stats(self):
+        return self.rate_limiter.stats()
+
+    def close(self):
+        self.client.close()
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
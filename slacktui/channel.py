@@ -1,16 +1,14 @@
-import httpx
+from slacktui.api import get_client
+from slacktui.messages import page_results
 
 
-def query_channels(config):
+def query_channels(config, page_size=1000):
     """
     Generator queries channels and produces entries corresponding to each one.
     """
-    url = "https://slack.com/api/conversations.list"
-    user_token = config["oauth"]["user_token"]
-    headers = {"Authorization": f"Bearer {user_token}"}
-    params = {"types": "public_channel,private_channel,mpim,im"}
-    response = httpx.get(url, headers=headers, params=params)
-    json_response = response.json()
-    channels = json_response["channels"]
-    for channel in channels:
-        yield channel
+    params = {"types": "public_channel,private_channel,mpim,im", "limit": page_size}
+    client = get_client(config)
+    for json_response in page_results(client, "conversations.list", params):
+        channels = json_response["channels"]
+        for channel in channels:
+            yield channel
@@ -1,6 +1,55 @@
+import functools
+import hashlib
 import json
 import pathlib
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from slacktui.filestore import (blob_path, delete_blob, delete_stale_partials,
+                                read_blob, write_blob)
+from slacktui.messages import message_transform
+
+DEFAULT_PRAGMAS = {
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+}
+
+DEFAULT_POOL_SIZE = 4
+
+DEFAULT_FILE_CACHE_MAX_BYTES = 1024**3
+
+# Unfinished downloads not resumed within this many days are deleted.
+DEFAULT_PARTIAL_MAX_AGE_DAYS = 1
+
+# How stale a cached file's last access time may get before a read updates it.
+BLOB_TOUCH_INTERVAL = 60
+
+DEFAULT_RENDER_CACHE_MAX_ROWS = 50000
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Sorts after every Slack message timestamp.
+MAX_TS = "9999999999.999999"
+
+RETENTION_LIMITS = ("max_age_days", "max_rows", "max_bytes")
+
+SEARCH_MARK_START = "\x02"
+SEARCH_MARK_END = "\x03"
+
+_synchronous_modes = frozenset(["OFF", "NORMAL", "FULL", "EXTRA"])
+_db_settings = {}
+_file_cache_limits = {}
+_partial_max_ages = {}
+_retention_policies = {}
+_pool_sizes = {}
+_pools = {}
+_pool_lock = threading.Lock()
+_local = threading.local()
 
 
 def get_db_path(workspace):
@@ -8,21 +57,438 @@ def get_db_path(workspace):
     return path
 
 
+def get_file_store_path(workspace):
+    """
+    Directory holding the workspace's cached file contents.
+    """
+    return get_db_path(workspace).with_suffix(".files")
+
+
+def configure_db(workspace, config):
+    """
+    Set the connection pragmas for a workspace from the `[database]` table of
+    its config.  Only connections opened afterwards pick up the new settings;
+    pooled connections are closed.
+    The file cache size limit comes from the `[files]` table and the message
+    retention policy from the `[retention]` table.
+    """
+    db_config = config.get("database", {})
+    pragmas = dict(DEFAULT_PRAGMAS)
+    for name in ("cache_size", "mmap_size", "busy_timeout"):
+        if name in db_config:
+            pragmas[name] = int(db_config[name])
+    synchronous = str(db_config.get("synchronous", pragmas["synchronous"])).upper()
+    if synchronous not in _synchronous_modes:
+        raise ValueError(f"Invalid value for database.synchronous: {synchronous}")
+    pragmas["synchronous"] = synchronous
+    _db_settings[workspace] = pragmas
+    _pool_sizes[workspace] = int(db_config.get("pool_size", DEFAULT_POOL_SIZE))
+    with _pool_lock:
+        stale = _pools.pop(workspace, [])
+    for conn in stale:
+        conn.close()
+    files_config = config.get("files", {})
+    _file_cache_limits[workspace] = int(
+        files_config.get("cache_max_bytes", DEFAULT_FILE_CACHE_MAX_BYTES)
+    )
+    _partial_max_ages[workspace] = float(
+        files_config.get("partial_max_age_days", DEFAULT_PARTIAL_MAX_AGE_DAYS)
+    )
+    _retention_policies[workspace] = config.get("retention", {})
+
+
+def open_connection(workspace):
+    """
+    Open and configure a new connection to the workspace DB.
+    The connection is in autocommit mode; use `transaction()` to group writes.
+    """
+    pragmas = _db_settings.get(workspace, DEFAULT_PRAGMAS)
+    path = get_db_path(workspace)
+    timeout = pragmas["busy_timeout"] / 1000
+    # Pooled connections move between threads, though only one thread uses a
+    # connection at a time.
+    conn = sqlite3.connect(
+        path, timeout=timeout, isolation_level=None, check_same_thread=False
+    )
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute(f"PRAGMA busy_timeout = {pragmas['busy_timeout']};")
+    conn.execute(f"PRAGMA cache_size = {pragmas['cache_size']};")
+    conn.execute(f"PRAGMA mmap_size = {pragmas['mmap_size']};")
+    conn.execute(f"PRAGMA synchronous = {pragmas['synchronous']};")
+    return conn
+
+
+def get_connection(workspace):
+    """
+    Return the calling thread's connection to the workspace DB.  On first use
+    it is taken from the workspace's pool, or opened if the pool is empty.
+    """
+    connections = _local.__dict__.setdefault("connections", {})
+    conn = connections.get(workspace)
+    if conn is None:
+        with _pool_lock:
+            pool = _pools.get(workspace)
+            if pool:
+                conn = pool.pop()
+        if conn is None:
+            conn = open_connection(workspace)
+        connections[workspace] = conn
+    return conn
+
+
+def close_connections():
+    """
+    Close all connections held by the calling thread.
+    """
+    connections = _local.__dict__.setdefault("connections", {})
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+
+def release_connections():
+    """
+    Return the connections held by the calling thread to their workspaces'
+    pools, so the next short-lived thread need not open and configure its
+    own.  Connections that do not fit in a pool are closed.
+    """
+    connections = _local.__dict__.setdefault("connections", {})
+    for workspace, conn in connections.items():
+        pool_size = _pool_sizes.get(workspace, DEFAULT_POOL_SIZE)
+        with _pool_lock:
+            pool = _pools.setdefault(workspace, [])
+            if not conn.in_transaction and len(pool) < pool_size:
+                pool.append(conn)
+                continue
+        conn.close()
+    connections.clear()
+
+
+def pooled_connections(func):
+    """
+    Decorate a function run on a short-lived thread, e.g. a Textual thread
+    worker, so the connections it uses go back to the pool when it returns.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        try:
+            return func(*args, **kwds)
+        finally:
+            release_connections()
+
+    return wrapper
+
+
+@contextmanager
+def transaction(workspace):
+    """
+    Run the enclosed block in a write transaction on the calling thread's
+    connection.  Nested blocks join the outermost transaction, which commits
+    when it exits cleanly and rolls back otherwise.
+    """
+    conn = get_connection(workspace)
+    depths = _local.__dict__.setdefault("depths", {})
+    depth = depths.get(workspace, 0)
+    if depth == 0:
+        conn.execute("BEGIN IMMEDIATE")
+    depths[workspace] = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        depths[workspace] = depth
+        if depth == 0 and conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    depths[workspace] = depth
+    if depth == 0:
+        conn.execute("COMMIT")
+
+
 def init_db(workspace):
     """
     Initialize the DB.
     """
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    conn = get_connection(workspace)
+    auto_vacuum = conn.execute("PRAGMA auto_vacuum;").fetchone()[0]
+    if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+        # Changing the mode of an existing DB only takes effect after VACUUM.
+        conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL};")
+        conn.execute("VACUUM;")
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
         cursor.execute(sql_create_channels_table)
         cursor.execute(sql_create_users_table)
         cursor.execute(sql_create_messages_table)
         cursor.execute(sql_create_files_table)
         cursor.execute(sql_create_emojis_table)
-        conn.commit()
+        upgrade_schema(cursor)
+
+
+def upgrade_schema(cursor):
+    """
+    Apply the schema upgrades the DB has not seen yet.
+    `PRAGMA user_version` records how many have been applied.
+    """
+    cursor.execute("PRAGMA user_version;")
+    version = cursor.fetchone()[0]
+    for n, upgrade in enumerate(schema_upgrades[version:], start=version + 1):
+        upgrade(cursor)
+        cursor.execute(f"PRAGMA user_version = {n};")
+
+
+def upgrade_add_message_seq(cursor):
+    """
+    Add a change sequence to messages so readers can ask for rows changed
+    since the last poll.
+    """
+    cursor.execute(sql_create_counters_table)
+    cursor.execute(sql_init_counter, {"name": "messages"})
+    cursor.execute(sql_add_message_seq_column)
+    cursor.execute(sql_create_message_seq_index)
+
+
+def upgrade_add_json_columns(cursor):
+    """
+    Expose the JSON fields used for joins, filters and sorting as indexed
+    virtual columns.
+    """
+    for sql in sql_add_json_columns:
+        cursor.execute(sql)
+
+
+def upgrade_add_reactions_table(cursor):
+    """
+    Move reactions out of the message blobs into their own tables: the
+    users who reacted, and the count Slack reported for each reaction.
+    """
+    cursor.execute(sql_create_reactions_table)
+    cursor.execute(sql_create_reaction_counts_table)
+    cursor.execute(sql_copy_blob_reactions)
+    cursor.execute(sql_copy_blob_reaction_counts)
+    cursor.execute(sql_strip_blob_reactions)
+
+
+def upgrade_add_search_index(cursor):
+    """
+    Add the full-text search index and index the messages already stored.
+    """
+    cursor.execute(sql_create_search_docs_table)
+    cursor.execute(sql_create_messages_fts_table)
+    cursor.execute(sql_create_messages_delete_trigger)
+    reader = cursor.connection.cursor()
+    reader.execute("SELECT channel_id, ts, json(json_blob) FROM messages")
+    for channel_id, ts, message_json in fetchrows(reader):
+        message = json.loads(message_json)
+        message["channel"] = channel_id
+        message["ts"] = ts
+        index_message(cursor, message)
+
+
+def upgrade_move_file_blobs(cursor):
+    """
+    Move file contents out of the `files` table into the on-disk file store.
+    """
+    cursor.execute(sql_create_blobs_table)
+    cursor.execute(sql_create_blobs_access_index)
+    cursor.execute(sql_add_files_sha256_column)
+    cursor.execute(sql_add_files_size_column)
+    cursor.execute("PRAGMA database_list;")
+    db_path = next(pathlib.Path(row[2]) for row in cursor if row[1] == "main")
+    root = db_path.with_suffix(".files")
+    cursor.execute("SELECT id FROM files WHERE data IS NOT NULL")
+    file_ids = [row[0] for row in cursor.fetchall()]
+    for file_id in file_ids:
+        cursor.execute(sql_load_file_data, {"file_id": file_id})
+        data = cursor.fetchone()[0]
+        sha256 = write_blob(root, data)
+        params = {
+            "file_id": file_id,
+            "sha256": sha256,
+            "size": len(data),
+            "last_access": time.time(),
+        }
+        cursor.execute(sql_upsert_blob, params)
+        cursor.execute(sql_move_file_data, params)
+
+
+def upgrade_add_channels_counter(cursor):
+    """
+    Count changes to the channel list so readers can tell when it needs
+    reloading.
+    """
+    cursor.execute(sql_init_counter, {"name": "channels"})
+
+
+def upgrade_add_render_cache(cursor):
+    """
+    Add the cache of rendered message markup and the triggers that drop
+    entries mentioning a renamed user or channel.
+    """
+    cursor.execute(sql_create_rendered_messages_table)
+    cursor.execute(sql_create_rendered_refs_table)
+    cursor.execute(sql_create_rendered_refs_digest_index)
+    cursor.execute(sql_create_rendered_messages_delete_trigger)
+    cursor.execute(sql_create_users_rename_trigger)
+    cursor.execute(sql_create_channels_rename_trigger)
+
+
+def upgrade_add_directory_seq(cursor):
+    """
+    Stamp users and channels with the `channels` counter value of their last
+    change so the in-memory directory can reload only changed rows.
+    """
+    for sql in sql_add_directory_seq_columns:
+        cursor.execute(sql)
+    cursor.execute(sql_create_users_insert_trigger)
+    cursor.execute(sql_create_channels_insert_trigger)
+
+
+def upgrade_add_json_hash(cursor):
+    """
+    Record a hash of each user's and channel's JSON so a sync can skip rows
+    that have not changed.
+    """
+    cursor.execute(sql_add_users_json_hash_column)
+    cursor.execute(sql_add_channels_json_hash_column)
+
+
+def upgrade_add_sync_state(cursor):
+    """
+    Track the span of each channel's history that has been synced.
+    """
+    cursor.execute(sql_create_sync_state_table)
+
+
+def upgrade_add_message_digest(cursor, batch_size=1000):
+    """
+    Store a digest of each message's content and reactions, so readers can
+    tell which messages changed without loading and hashing them.
+    """
+    # Message JSON is read with the reaction counts, whose table DBs upgraded
+    # past the reactions table before it existed do not have yet.
+    cursor.execute(sql_create_reaction_counts_table)
+    cursor.execute(sql_add_message_digest_column)
+    reader = cursor.connection.cursor()
+    reader.execute(sql_load_all_message_json)
+    rows = fetchrows(reader, num_rows=batch_size)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if len(batch) == 0:
+            break
+        cursor.executemany(
+            sql_update_message_digest,
+            (
+                {
+                    "channel_id": channel_id,
+                    "ts": ts,
+                    "digest": compute_message_digest(json.loads(message_json)),
+                }
+                for channel_id, ts, message_json in batch
+            ),
+        )
+    # The new index is built once the digests are filled in, rather than
+    # updated row by row.
+    cursor.execute(sql_drop_message_seq_index)
+    cursor.execute(sql_create_message_digest_index)
+
+
+def upgrade_add_reaction_counts(cursor):
+    """
+    Keep the reaction counts Slack reports, which exceed the stored users
+    when Slack truncates a popular reaction's user list.  Only DBs upgraded
+    past the message digests before the table existed still lack it.
+    """
+    cursor.execute(sql_create_reaction_counts_table)
+
+
+schema_upgrades = [
+    upgrade_add_message_seq,
+    upgrade_add_json_columns,
+    upgrade_add_reactions_table,
+    upgrade_add_search_index,
+    upgrade_move_file_blobs,
+    upgrade_add_channels_counter,
+    upgrade_add_render_cache,
+    upgrade_add_directory_seq,
+    upgrade_add_json_hash,
+    upgrade_add_sync_state,
+    upgrade_add_message_digest,
+    upgrade_add_reaction_counts,
+]
+
+
+def next_seq(cursor, name):
+    """
+    Advance the named counter and return its new value.
+    Must be called inside a write transaction.
+    """
+    cursor.execute(sql_next_seq, {"name": name})
+    return cursor.fetchone()[0]
+
+
+def message_search_text(message):
+    """
+    Extract the plain text of a message for the search index.
+    Rich text blocks are preferred over the `text` fallback when present.
+    """
+    parts = []
+    blocks = message.get("blocks")
+    if blocks:
+        for block in blocks:
+            collect_block_text(block, parts)
+            parts.append("\n")
+    else:
+        parts.append(message.get("text") or "")
+    for file_info in message.get("files", []):
+        parts.append(f"\n{file_info.get('title') or file_info.get('name') or ''}")
+    return "".join(parts).strip()
+
+
+def collect_block_text(node, parts):
+    """
+    Append the text found in a block element tree to `parts`.
+    """
+    if isinstance(node, list):
+        for item in node:
+            collect_block_text(item, parts)
+        return
+    if not isinstance(node, dict):
+        return
+    text = node.get("text")
+    if isinstance(text, str):
+        parts.append(text)
+    elif text is not None:
+        collect_block_text(text, parts)
+    elif node.get("type") == "link":
+        parts.append(f" {node.get('url', '')} ")
+    for key in ("elements", "fields"):
+        child = node.get(key)
+        if child is not None:
+            collect_block_text(child, parts)
+
+
+def index_message(cursor, message):
+    """
+    Add or replace a message in the full-text search index.
+    Must be called inside a write transaction.
+    """
+    params = {"channel_id": message["channel"], "ts": message["ts"]}
+    cursor.execute(sql_upsert_search_doc, params)
+    doc_id = cursor.fetchone()[0]
+    params = {"doc_id": doc_id, "text": message_search_text(message)}
+    cursor.execute(sql_delete_search_text, params)
+    cursor.execute(sql_insert_search_text, params)
+
+
+def make_search_query(text):
+    """
+    Turn free text into an FTS5 query that matches every word as a prefix.
+    """
+    words = text.split()
+    terms = ['"{}"*'.format(word.replace('"', '""')) for word in words]
+    return " ".join(terms)
 
 
 def fetchrows(cursor, num_rows=None, row_wrapper=None):
@@ -57,47 +523,61 @@ def get_columns_from_cursor(cursor):
     return columns
 
 
-def load_emojis(workspace, ref_code, max_results=9, reverse=False, fltr=None):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
-        cursor = conn.cursor()
-        if fltr is not None:
-            fltr = f"%{fltr}%"
-        else:
-            fltr = "%"
-        if reverse:
-            params = {"ref_code": ref_code, "max_results": max_results, "fltr": fltr}
-            print(params)
-            cursor.execute(
-                sql_load_prev_emojis,
-                params,
-            )
-        else:
-            params = {"ref_code": ref_code, "max_results": max_results, "fltr": fltr}
-            print(params)
-            cursor.execute(sql_load_next_emojis, params)
-        for row in fetchrows(cursor, row_wrapper=row2dict):
-            parts = row["unified"].split("-")
-            chars = [chr(int(part, 16)) for part in parts]
-            symbol = "".join(chars)
-            row["emoji"] = symbol
-            yield row
+def load_emojis(workspace):
+    """
+    The emoji catalog as (short code, glyph) pairs.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_emojis)
+    for short_code, unified in fetchrows(cursor):
+        parts = unified.split("-")
+        chars = [chr(int(part, 16)) for part in parts]
+        yield short_code, "".join(chars)
+
+
+def load_reaction_usage(workspace, user_id):
+    """
+    Map each reaction a user has made to the timestamp of the newest message
+    they reacted to with it.  When a reaction was added is not recorded, so
+    the message time stands in for it.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_reaction_usage, {"user_id": user_id})
+    return dict((name, float(ts)) for name, ts in fetchrows(cursor))
 
 
 def load_file(workspace, file_id):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
-        cursor = conn.cursor()
-        cursor.execute(sql_load_file, {"file_id": file_id})
-        columns = get_columns_from_cursor(cursor)
-        row = cursor.fetchone()
-        if row is None:
-            return None
-        return row2dict(columns, row)
+    """
+    Load a cached file.  `data` is a read-only memory map of the contents and
+    `path` is where they live on disk.
+    Return None if the file is not cached.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_file, {"file_id": file_id})
+    columns = get_columns_from_cursor(cursor)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    file_info = row2dict(columns, row)
+    root = get_file_store_path(workspace)
+    data = read_blob(root, file_info["sha256"])
+    if data is None:
+        return None
+    file_info["data"] = data
+    file_info["path"] = blob_path(root, file_info["sha256"])
+    last_access = file_info.pop("last_access")
+    now = time.time()
+    if last_access is None or now - last_access >= BLOB_TOUCH_INTERVAL:
+        params = {"sha256": file_info["sha256"], "last_access": now}
+        try:
+            conn.execute(sql_touch_blob, params)
+        except sqlite3.OperationalError as ex:
+            # Eviction order need not be exact; never fail a read over it.
+            print(f"Could not update the last access time of file {file_id}: {ex}")
+    return file_info
 
 
 def load_channels(workspace, load_dms=False):
@@ -106,143 +586,636 @@ def load_channels(workspace, load_dms=False):
     if load_dms:
         is_channel = False
         is_im = True
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
-        cursor = conn.cursor()
-        cursor.execute(sql_load_channels, {"is_channel": is_channel, "is_im": is_im})
-        for row in fetchrows(cursor):
-            yield row
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_channels, {"is_channel": is_channel, "is_im": is_im})
+    for row in fetchrows(cursor):
+        yield row
 
 
 def load_channel(workspace, channel_id):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
-        cursor = conn.cursor()
-        cursor.execute(sql_load_channel, {"channel_id": channel_id})
-        columns = get_columns_from_cursor(cursor)
-        row = cursor.fetchone()
-        if row is None:
-            return None
-        return row2dict(columns, row)
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_channel, {"channel_id": channel_id})
+    columns = get_columns_from_cursor(cursor)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row2dict(columns, row)
+
+
+def find_channel_id(workspace, name):
+    """
+    Look up a channel ID by channel name.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_find_channel_id, {"name": name})
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def load_member_channel_ids(workspace):
+    """
+    IDs of the channels, group DMs and DMs whose history the user can read.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_member_channel_ids)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def find_user_id(workspace, name):
+    """
+    Look up a user ID by user name or display name.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_find_user_id, {"name": name})
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def load_users_since(workspace, seq):
+    """
+    Users added or changed after change sequence `seq`.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_users_since, {"seq": seq})
+    return fetchrows(cursor, row_wrapper=row2dict)
+
+
+def load_channels_since(workspace, seq):
+    """
+    Channels added or changed after change sequence `seq`.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_channels_since, {"seq": seq})
+    return fetchrows(cursor, row_wrapper=row2dict)
 
 
 def load_user(workspace, user_id):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
-        cursor = conn.cursor()
-        cursor.execute(sql_load_user, {"user_id": user_id})
-        columns = get_columns_from_cursor(cursor)
-        row = cursor.fetchone()
-        if row is None:
-            return None
-        return row2dict(columns, row)
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_user, {"user_id": user_id})
+    columns = get_columns_from_cursor(cursor)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row2dict(columns, row)
 
 
 def load_users(workspace):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
-        cursor = conn.cursor()
-        cursor.execute(sql_load_users)
-        for row in fetchrows(cursor, row_wrapper=row2dict):
-            yield row
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_users)
+    for row in fetchrows(cursor, row_wrapper=row2dict):
+        yield row
 
 
 def load_messages(workspace, channel_id=None):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_messages, {"channel_id": channel_id})
+    for row in fetchrows(cursor, row_wrapper=row2dict):
+        yield row
+
+
+def load_messages_since(workspace, channel_id, seq):
+    """
+    Load the messages in a channel that were inserted or updated after change
+    sequence `seq`.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_messages_since, {"channel_id": channel_id, "seq": seq})
+    for row in fetchrows(cursor, row_wrapper=row2dict):
+        yield row
+
+
+def load_message_digests_since(workspace, channel_id, seq):
+    """
+    The timestamp, change sequence and digest of the messages in a channel
+    that were inserted or updated after change sequence `seq`.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    params = {"channel_id": channel_id, "seq": seq}
+    cursor.execute(sql_load_message_digests_since, params)
+    return list(fetchrows(cursor, row_wrapper=row2dict))
+
+
+def load_message_digests_between(workspace, channel_id, first_ts=None, last_ts=None):
+    """
+    The timestamp and digest of each message in a channel from `first_ts` to
+    `last_ts` inclusive, in timestamp order.  Either end may be left open.
+    """
+    if first_ts is None:
+        first_ts = ""
+    if last_ts is None:
+        last_ts = MAX_TS
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    params = {"channel_id": channel_id, "first_ts": first_ts, "last_ts": last_ts}
+    cursor.execute(sql_load_message_digests_between, params)
+    return list(fetchrows(cursor, row_wrapper=row2dict))
+
+
+def load_messages_by_ts(workspace, channel_id, timestamps):
+    """
+    Load the messages of a channel with the given timestamps, in timestamp
+    order.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    params = {"channel_id": channel_id, "timestamps": json.dumps(list(timestamps))}
+    cursor.execute(sql_load_messages_by_ts, params)
+    return list(fetchrows(cursor, row_wrapper=row2dict))
+
+
+def load_messages_page(workspace, channel_id, before_ts=None, after_ts=None, limit=50):
+    """
+    Load up to `limit` messages of a channel in timestamp order, paging by
+    key: the newest ones older than `before_ts`, or the oldest ones newer than
+    `after_ts`.  Without either, load the newest messages in the channel.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    if after_ts is not None:
+        params = {"channel_id": channel_id, "ts": after_ts, "limit": limit}
+        cursor.execute(sql_load_messages_after, params)
+        return list(fetchrows(cursor, row_wrapper=row2dict))
+    if before_ts is None:
+        before_ts = MAX_TS
+    params = {"channel_id": channel_id, "ts": before_ts, "limit": limit}
+    cursor.execute(sql_load_messages_before, params)
+    rows = list(fetchrows(cursor, row_wrapper=row2dict))
+    rows.reverse()
+    return rows
+
+
+def load_rendered_message(workspace, digest, version):
+    """
+    Cached rendering of the message with content digest `digest` produced by
+    renderer `version`.
+    Return a dict with `markup` and `reactions`, or None on a miss.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_rendered_message, {"digest": digest, "version": version})
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    markup, reactions = row
+    if reactions is not None:
+        reactions = json.loads(reactions)
+    return {"markup": markup, "reactions": reactions}
+
+
+def load_sync_state(workspace, channel_id):
+    """
+    The synced span of a channel's history as a dict with `oldest_ts`,
+    `newest_ts` and `last_sync`, or None if it has never been synced.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_sync_state, {"channel_id": channel_id})
+    columns = get_columns_from_cursor(cursor)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row2dict(columns, row)
+
+
+def load_counter(workspace, name):
+    """
+    Current value of a change counter.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_counter, {"name": name})
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+    return row[0]
+
+
+def load_channel_seq(workspace, channel_id):
+    """
+    Latest change sequence of any message in a channel.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_channel_seq, {"channel_id": channel_id})
+    return cursor.fetchone()[0]
+
+
+def search_messages(
+    workspace,
+    query,
+    channel_id=None,
+    user_id=None,
+    since=None,
+    until=None,
+    limit=20,
+    offset=0,
+):
+    """
+    Full-text search over all stored messages, best matches first.
+    `query` uses FTS5 query syntax; see `make_search_query()`.
+    `since` and `until` bound the message time in epoch seconds.
+    Matched terms in the returned snippet are wrapped in SEARCH_MARK_START and
+    SEARCH_MARK_END.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    params = {
+        "query": query,
+        "channel_id": channel_id,
+        "user_id": user_id,
+        "since": since,
+        "until": until,
+        "limit": limit,
+        "offset": offset,
+        "mark_start": SEARCH_MARK_START,
+        "mark_end": SEARCH_MARK_END,
+    }
+    cursor.execute(sql_search_messages, params)
+    for row in fetchrows(cursor, row_wrapper=row2dict):
+        yield row
+
+
+def get_retention_policy(workspace, channel_id):
+    """
+    Effective retention limits for a channel: the workspace-wide limits in
+    `[retention]` overridden by those in `[retention.channels.<channel ID>]`.
+    """
+    config = _retention_policies.get(workspace, {})
+    channel_config = config.get("channels", {}).get(channel_id, {})
+    policy = {}
+    for name in RETENTION_LIMITS:
+        value = channel_config.get(name, config.get(name))
+        if value is not None:
+            policy[name] = value
+    return policy
+
+
+def ts_after(ts):
+    """
+    A cutoff that sorts just after the message timestamp `ts`, so that
+    `ts < cutoff` selects it and everything older.
+    """
+    return f"{ts}0"
+
+
+def find_retention_cutoff(cursor, channel_id, policy):
+    """
+    Return the timestamp before which the messages of a channel exceed its
+    retention policy, or None if they all fit.
+    """
+    cutoffs = []
+    max_age_days = policy.get("max_age_days")
+    if max_age_days is not None:
+        cutoffs.append(f"{time.time() - max_age_days * 86400:.6f}")
+    max_rows = policy.get("max_rows")
+    if max_rows is not None:
+        params = {"channel_id": channel_id, "offset": max_rows}
+        cursor.execute(sql_load_nth_newest_message_ts, params)
+        row = cursor.fetchone()
+        if row is not None:
+            cutoffs.append(ts_after(row[0]))
+    max_bytes = policy.get("max_bytes")
+    if max_bytes is not None:
+        cursor.execute(sql_load_message_sizes, {"channel_id": channel_id})
+        total = 0
+        for ts, size in fetchrows(cursor):
+            total += size
+            if total > max_bytes:
+                cutoffs.append(ts_after(ts))
+                break
+    if len(cutoffs) == 0:
+        return None
+    return max(cutoffs)
+
+
+def prune_messages(workspace, batch_size=500, pause=0.05):
+    """
+    Delete the messages that fall outside the retention policy, `batch_size`
+    rows per transaction so readers and writers are not blocked for long.
+    Return a mapping of channel ID to the number of messages deleted.
+    """
+    conn = get_connection(workspace)
+    cursor = conn.cursor()
+    cursor.execute(sql_load_message_channel_ids)
+    channel_ids = [row[0] for row in cursor.fetchall()]
+    deleted = {}
+    for channel_id in channel_ids:
+        policy = get_retention_policy(workspace, channel_id)
+        if len(policy) == 0:
+            continue
+        cutoff = find_retention_cutoff(cursor, channel_id, policy)
+        if cutoff is None:
+            continue
+        params = {"channel_id": channel_id, "cutoff": cutoff, "limit": batch_size}
+        count = 0
+        while True:
+            with transaction(workspace) as conn:
+                rowcount = conn.execute(sql_prune_messages, params).rowcount
+            count += rowcount
+            if rowcount < batch_size:
+                break
+            time.sleep(pause)
+        if count > 0:
+            deleted[channel_id] = count
+    return deleted
+
+
+def reclaim_space(workspace, pages_per_step=1000, pause=0.05):
+    """
+    Return free pages to the file system a few at a time.
+    Return the number of bytes reclaimed.
+    """
+    conn = get_connection(workspace)
+    page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+    reclaimed = 0
+    while True:
+        free_pages = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        if free_pages == 0:
+            break
+        # execute() would only step the pragma once, freeing a single page.
+        conn.executescript(f"PRAGMA incremental_vacuum({pages_per_step});")
+        remaining = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        if remaining >= free_pages:
+            break
+        reclaimed += (free_pages - remaining) * page_size
+        time.sleep(pause)
+    return reclaimed
+
+
+def run_maintenance(workspace, batch_size=500):
+    """
+    Enforce the retention policy and reclaim the space it frees, and delete
+    abandoned partial downloads.
+    Return a report of what was deleted and reclaimed.
+    """
+    deleted = prune_messages(workspace, batch_size=batch_size)
+    prune_render_cache(workspace)
+    reclaimed = reclaim_space(workspace)
+    max_age_days = _partial_max_ages.get(workspace, DEFAULT_PARTIAL_MAX_AGE_DAYS)
+    partial_bytes = delete_stale_partials(
+        get_file_store_path(workspace), max_age_days * 86400
+    )
+    return {
+        "deleted_messages": sum(deleted.values()),
+        "deleted_by_channel": deleted,
+        "reclaimed_bytes": reclaimed,
+        "deleted_partial_bytes": partial_bytes,
+    }
+
+
+def prune_render_cache(workspace, max_rows=DEFAULT_RENDER_CACHE_MAX_ROWS):
+    """
+    Drop the oldest rendered messages beyond `max_rows`.
+    """
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
-        cursor.execute(sql_load_messages, {"channel_id": channel_id})
-        for row in fetchrows(cursor, row_wrapper=row2dict):
-            yield row
+        cursor.execute(sql_prune_rendered_messages, {"max_rows": max_rows})
+        return cursor.rowcount
+
+
+def store_rendered_message(workspace, digest, version, markup, reactions, refs):
+    """
+    Cache the rendering of a message.
+    `refs` are the IDs of the users and channels whose names appear in the
+    markup; renaming any of them drops the entry.
+    The cache is best-effort: if the DB is locked, the entry is not stored.
+    """
+    if reactions is not None:
+        reactions = json.dumps(reactions)
+    params = {
+        "digest": digest,
+        "version": version,
+        "markup": markup,
+        "reactions": reactions,
+    }
+    try:
+        with transaction(workspace) as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql_insert_rendered_message, params)
+            cursor.executemany(
+                sql_insert_rendered_ref,
+                [{"digest": digest, "ref_id": ref_id} for ref_id in refs],
+            )
+    except sqlite3.OperationalError as ex:
+        print(f"Could not cache rendered message {digest}: {ex}")
 
 
 def store_file(
     workspace, file_id, data, name, timestamp=None, title=None, mimetype=None
 ):
+    """
+    Add file contents to the file store and record the file's metadata.
+    """
+    sha256 = write_blob(get_file_store_path(workspace), data)
+    store_file_blob(
+        workspace,
+        file_id,
+        sha256,
+        len(data),
+        name,
+        timestamp=timestamp,
+        title=title,
+        mimetype=mimetype,
+    )
+
+
+def store_file_blob(
+    workspace,
+    file_id,
+    sha256,
+    size,
+    name,
+    timestamp=None,
+    title=None,
+    mimetype=None,
+):
+    """
+    Record the metadata of a file whose contents are already in the file
+    store under the digest `sha256`.
+    """
     if title is None:
         title = name
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
         params = {
             "file_id": file_id,
-            "data": data,
+            "sha256": sha256,
+            "size": size,
+            "last_access": time.time(),
             "name": name,
             "timestamp": timestamp,
             "title": title,
             "mimetype": mimetype,
         }
+        cursor.execute(sql_upsert_blob, params)
         cursor.execute(sql_insert_file, params)
+    evict_file_cache(workspace)
 
 
-def store_channels(workspace, channels):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+def evict_file_cache(workspace, max_bytes=None):
+    """
+    Delete the least recently used file contents until the file store fits in
+    `max_bytes` (by default the configured `files.cache_max_bytes`).
+    Return the number of bytes evicted.
+    """
+    if max_bytes is None:
+        max_bytes = _file_cache_limits.get(workspace, DEFAULT_FILE_CACHE_MAX_BYTES)
+    evicted = []
+    evicted_bytes = 0
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
-        for channel in channels:
-            channel_id = channel["id"]
-            channel_json = json.dumps(channel)
-            cursor.execute(
-                sql_insert_channel,
-                {"channel_id": channel_id, "channel_json": channel_json},
-            )
-        conn.commit()
+        cursor.execute(sql_file_cache_size)
+        total = cursor.fetchone()[0]
+        if total <= max_bytes:
+            return 0
+        cursor.execute(sql_load_blobs_by_access)
+        for sha256, size in fetchrows(cursor):
+            if total - evicted_bytes <= max_bytes:
+                break
+            evicted.append(sha256)
+            evicted_bytes += size
+        cursor.executemany(sql_delete_blob, ({"sha256": d} for d in evicted))
+    root = get_file_store_path(workspace)
+    for sha256 in evicted:
+        delete_blob(root, sha256)
+    return evicted_bytes
 
 
-def store_users(workspace, users):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
-        cursor = conn.cursor()
-        for user in users:
-            user_id = user["id"]
-            user_json = json.dumps(user)
-            cursor.execute(
-                sql_insert_user,
-                {"user_id": user_id, "user_json": user_json},
+def store_channels(workspace, channels, batch_size=1000):
+    """
+    Insert or update channels from an iterable, `batch_size` per transaction.
+    Channels whose JSON has not changed are left untouched.
+    Return the number of channels added or changed.
+    """
+    return store_directory_rows(workspace, sql_insert_channel, channels, batch_size)
+
+
+def store_users(workspace, users, batch_size=1000):
+    """
+    Insert or update users from an iterable, `batch_size` per transaction.
+    Users whose JSON has not changed are left untouched.
+    Return the number of users added or changed.
+    """
+    return store_directory_rows(workspace, sql_insert_user, users, batch_size)
+
+
+def store_directory_rows(workspace, sql, items, batch_size):
+    items = iter(items)
+    changed = 0
+    while True:
+        batch = list(islice(items, batch_size))
+        if len(batch) == 0:
+            break
+        params = []
+        for item in batch:
+            item_json = json.dumps(item, sort_keys=True)
+            params.append(
+                {
+                    "id": item["id"],
+                    "json": item_json,
+                    "json_hash": hashlib.sha1(item_json.encode()).hexdigest(),
+                }
             )
-        conn.commit()
+        with transaction(workspace) as conn:
+            cursor = conn.cursor()
+            cursor.executemany(sql, params)
+            rowcount = cursor.rowcount
+            if rowcount > 0:
+                # The rows were stamped with the counter's next value.
+                next_seq(cursor, "channels")
+                changed += rowcount
+    return changed
 
 
 def store_message(workspace, message):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    """
+    Insert or update a message.  Its reactions are stored in the reactions
+    and reaction_counts tables, replacing any reactions already recorded for
+    the message.
+    """
+    message = dict(message)
+    reactions = message.pop("reactions", None) or []
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
         ts = message["ts"]
         channel_id = message["channel"]
         message_json = json.dumps(message)
+        seq = next_seq(cursor, "messages")
         cursor.execute(
             sql_insert_message,
             {
                 "ts": ts,
                 "channel_id": channel_id,
                 "message_json": message_json,
+                "seq": seq,
             },
         )
+        cursor.execute(
+            sql_delete_message_reactions, {"channel_id": channel_id, "ts": ts}
+        )
+        cursor.execute(
+            sql_delete_message_reaction_counts, {"channel_id": channel_id, "ts": ts}
+        )
+        cursor.executemany(
+            sql_insert_reaction_count,
+            (
+                {
+                    "channel_id": channel_id,
+                    "ts": ts,
+                    "name": r["name"],
+                    "count": r["count"],
+                }
+                for r in reactions
+                if r.get("count") is not None
+            ),
+        )
+        cursor.executemany(
+            sql_insert_reaction,
+            (
+                {"channel_id": channel_id, "ts": ts, "name": r["name"], "user_id": u}
+                for r in reactions
+                for u in r.get("users", [])
+            ),
+        )
+        update_message_digest(cursor, channel_id, ts)
+        index_message(cursor, message)
+
+
+def store_history(workspace, channel_id, messages, oldest_ts, newest_ts):
+    """
+    Store synced messages of a channel and record that its history from
+    `oldest_ts` to `newest_ts` has been synced, in one transaction.
+    """
+    with transaction(workspace) as conn:
+        for message in messages:
+            store_message(workspace, message)
+        params = {
+            "channel_id": channel_id,
+            "oldest_ts": oldest_ts,
+            "newest_ts": newest_ts,
+            "last_sync": time.time(),
+        }
+        conn.execute(sql_upsert_sync_state, params)
 
 
 def mark_channel_read(workspace, channel_id):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
         print(f"Marking channel {channel_id} read ...")
         print(f"SQL: {sql_update_channel_read_status}")
@@ -250,14 +1223,12 @@ def mark_channel_read(workspace, channel_id):
         cursor.execute(
             sql_update_channel_read_status, {"channel_id": channel_id, "read": read}
         )
-        conn.commit()
+        if cursor.rowcount > 0:
+            next_seq(cursor, "channels")
 
 
 def mark_channel_unread(workspace, channel_id):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
         print(f"Marking channel {channel_id} read ...")
         print(f"SQL: {sql_update_channel_read_status}")
@@ -265,186 +1236,358 @@ def mark_channel_unread(workspace, channel_id):
         cursor.execute(
             sql_update_channel_read_status, {"channel_id": channel_id, "read": read}
         )
-        conn.commit()
+        if cursor.rowcount > 0:
+            next_seq(cursor, "channels")
+
+
+def compute_message_digest(message):
+    """
+    Content digest of a message over its `message_transform` fields.
+    """
+    canonical = json.dumps(
+        message_transform(message), sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def update_message_digest(cursor, channel_id, ts):
+    """
+    Recompute the stored digest of a message from its content and reactions.
+    """
+    params = {"channel_id": channel_id, "ts": ts}
+    cursor.execute(sql_load_message_json, params)
+    row = cursor.fetchone()
+    if row is None:
+        return
+    params["digest"] = compute_message_digest(json.loads(row[0]))
+    cursor.execute(sql_update_message_digest, params)
 
 
 def add_reaction(workspace, event):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    """
+    Record a reaction to a stored message.
+    """
+    params = {
+        "channel_id": event["item"]["channel"],
+        "ts": event["item"]["ts"],
+        "name": event["reaction"],
+        "user_id": event["user"],
+    }
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
-        ts = event["item"]["ts"]
-        channel_id = event["item"]["channel"]
-        cursor.execute(sql_load_message, {"channel_id": channel_id, "ts": ts})
-        row = cursor.fetchone()
-        if row is None:
-            return
-        message = json.loads(row[0])
-        reactions = message.setdefault("reactions", [])
-        added_reaction = event["reaction"]
-        updated = False
-        user = event["user"]
-        users = [user]
-        for reaction in reactions:
-            name = reaction["name"]
-            if name == added_reaction:
-                count = reaction["count"]
-                reaction["count"] = count + 1
-                users = reaction["users"]
-                if user not in users:
-                    users.append(user)
-                updated = True
-                break
-        if not updated:
-            reaction = {
-                "name": added_reaction,
-                "users": users,
-                "count": 1,
-            }
-            reactions.append(reaction)
-    store_message(workspace, message)
+        cursor.execute(sql_insert_reaction_if_message, params)
+        if cursor.rowcount > 0:
+            cursor.execute(sql_increment_reaction_count, params)
+            params["seq"] = next_seq(cursor, "messages")
+            cursor.execute(sql_touch_message, params)
+            update_message_digest(cursor, params["channel_id"], params["ts"])
 
 
 def remove_reaction(workspace, event):
-    path = get_db_path(workspace)
-    with sqlite3.connect(path) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    """
+    Remove a reaction from a stored message.
+    """
+    params = {
+        "channel_id": event["item"]["channel"],
+        "ts": event["item"]["ts"],
+        "name": event["reaction"],
+        "user_id": event["user"],
+    }
+    with transaction(workspace) as conn:
         cursor = conn.cursor()
-        ts = event["item"]["ts"]
-        channel_id = event["item"]["channel"]
-        cursor.execute(sql_load_message, {"channel_id": channel_id, "ts": ts})
-        row = cursor.fetchone()
-        if row is None:
-            return
-        message = json.loads(row[0])
-        reactions = message.get("reactions")
-        if reactions is None:
-            return
-        removed_reaction = event["reaction"]
-        updated = False
-        for n, reaction in enumerate(reactions):
-            name = reaction["name"]
-            if name == removed_reaction:
-                count = reaction["count"]
-                count -= 1
-                reaction["count"] = count
-                updated = True
-                break
-        if updated:
-            if count == 0:
-                pos = n + 1
-                reactions = reactions[:n] + reactions[pos:]
-            if len(reactions) == 0:
-                del message["reactions"]
-            else:
-                message["reactions"] = reactions
-    store_message(workspace, message)
-
-
-sql_load_next_emojis = """\
-    SELECT short_code, unified
-    FROM emojis
-    WHERE short_code > :ref_code
-    AND short_code LIKE :fltr
-    ORDER BY short_code
-    LIMIT :max_results
-    """
-
-sql_load_prev_emojis = """\
-    SELECT short_code, unified
-    FROM emojis
-    WHERE short_code < :ref_code
-    AND short_code LIKE :fltr
-    ORDER BY short_code DESC
-    LIMIT :max_results
+        cursor.execute(sql_delete_reaction, params)
+        changed = cursor.rowcount
+        # The user may be missing from a truncated user list while still
+        # being counted.
+        cursor.execute(sql_decrement_reaction_count, params)
+        changed += cursor.rowcount
+        if changed > 0:
+            params["seq"] = next_seq(cursor, "messages")
+            cursor.execute(sql_touch_message, params)
+            update_message_digest(cursor, params["channel_id"], params["ts"])
+
+
+sql_load_emojis = """\
+    SELECT short_code, unified FROM emojis ORDER BY short_code
+    """
+
+sql_load_reaction_usage = """\
+    SELECT name, MAX(ts)
+    FROM reactions
+    WHERE user_id = :user_id
+    GROUP BY name
     """
 
 sql_update_channel_read_status = """\
     UPDATE channels
-    SET read = :read
-    WHERE id = :channel_id
+    SET
+        read = :read,
+        seq = (SELECT value + 1 FROM counters WHERE name = 'channels')
+    WHERE id = :channel_id AND read IS NOT :read
     """
 
 
 sql_load_file = """\
     SELECT
-        timestamp,
-        name,
-        title,
-        mimetype,
-        data
-    FROM files
-    WHERE id = :file_id
+        f.timestamp,
+        f.name,
+        f.title,
+        f.mimetype,
+        f.sha256,
+        f.size,
+        b.last_access
+    FROM files f
+        INNER JOIN blobs b
+            ON b.sha256 = f.sha256
+    WHERE f.id = :file_id
     """
 
+sql_file_cache_size = """\
+    SELECT COALESCE(SUM(size), 0) FROM blobs
+    """
 
-sql_load_message = """\
-    SELECT
-        json_blob->'$' json_blob
+sql_load_blobs_by_access = """\
+    SELECT sha256, size FROM blobs ORDER BY last_access
+    """
+
+
+sql_load_message_channel_ids = """\
+    SELECT id FROM channels
+    WHERE EXISTS (SELECT 1 FROM messages m WHERE m.channel_id = channels.id)
+    """
+
+sql_load_nth_newest_message_ts = """\
+    SELECT ts
     FROM messages
     WHERE channel_id = :channel_id
-    AND ts = :ts
+    ORDER BY ts DESC
+    LIMIT 1 OFFSET :offset
+    """
+
+sql_load_message_sizes = """\
+    SELECT ts, length(json_blob)
+    FROM messages
+    WHERE channel_id = :channel_id
+    ORDER BY ts DESC
+    """
+
+sql_prune_messages = """\
+    DELETE FROM messages
+    WHERE rowid IN (
+        SELECT rowid
+        FROM messages
+        WHERE channel_id = :channel_id
+        AND ts < :cutoff
+        ORDER BY ts
+        LIMIT :limit
+    )
+    """
+
+sql_search_messages = """\
+    SELECT
+        d.channel_id,
+        d.ts,
+        m.user_id,
+        u.name user,
+        c.name channel,
+        snippet(messages_fts, 0, :mark_start, :mark_end, '…', 16) snippet,
+        f.rank
+    FROM messages_fts f
+        INNER JOIN search_docs d
+            ON d.id = f.rowid
+        INNER JOIN messages m
+            ON m.channel_id = d.channel_id
+            AND m.ts = d.ts
+        LEFT OUTER JOIN users u
+            ON u.id = m.user_id
+        LEFT OUTER JOIN channels c
+            ON c.id = d.channel_id
+    WHERE messages_fts MATCH :query
+    AND (:channel_id IS NULL OR d.channel_id = :channel_id)
+    AND (:user_id IS NULL OR m.user_id = :user_id)
+    AND (:since IS NULL OR CAST(d.ts AS REAL) >= :since)
+    AND (:until IS NULL OR CAST(d.ts AS REAL) < :until)
+    ORDER BY f.rank
+    LIMIT :limit OFFSET :offset
     """
 
 
-sql_load_messages = """\
+# A message's JSON with its reactions from the reactions and reaction_counts
+# tables.  A reaction's count is the larger of the count Slack reported and the
+# users stored, so it outlives the users of a truncated list being removed.
+sql_message_json = """\
+    json_patch(
+        m.json_blob,
+        json_object('reactions', json(nullif((
+            SELECT json_group_array(
+                json_object('name', name, 'users', json(users), 'count', count)
+            )
+            FROM (
+                SELECT
+                    name,
+                    json_group_array(user_id) FILTER (WHERE user_id IS NOT NULL)
+                        users,
+                    MAX(COUNT(user_id), COALESCE(MAX(reported), 0)) count
+                FROM (
+                    SELECT r.name, r.user_id, NULL reported, r.rowid user_pos, NULL pos
+                    FROM reactions r
+                    WHERE r.channel_id = m.channel_id
+                    AND r.ts = m.ts
+                    UNION ALL
+                    SELECT c.name, NULL, c.count, NULL, c.rowid
+                    FROM reaction_counts c
+                    WHERE c.channel_id = m.channel_id
+                    AND c.ts = m.ts
+                )
+                GROUP BY name
+                HAVING MAX(COUNT(user_id), COALESCE(MAX(reported), 0)) > 0
+                ORDER BY MIN(user_pos) NULLS LAST, MIN(pos)
+            )
+        ), '[]')))
+    )
+    """
+
+sql_select_messages = f"""\
     SELECT
         m.ts,
-        u.json_blob->>'name' user,
+        m.seq,
+        m.digest,
+        u.name user,
         m.json_blob->'files' files_json,
-        m.json_blob->'$' json_blob
+        {sql_message_json.strip()} json_blob
+    FROM messages m
+        INNER JOIN users u
+            ON u.id = m.user_id
+    """
+
+sql_load_messages = sql_select_messages + """\
+    WHERE m.channel_id = :channel_id
+    ORDER BY m.ts
+    """
+
+sql_load_messages_since = sql_select_messages + """\
+    WHERE m.channel_id = :channel_id
+    AND m.seq > :seq
+    ORDER BY m.ts
+    """
+
+sql_load_message_digests_since = """\
+    SELECT ts, seq, digest
+    FROM messages
+    WHERE channel_id = :channel_id
+    AND seq > :seq
+    ORDER BY ts
+    """
+
+sql_load_message_digests_between = """\
+    SELECT m.ts, m.digest
     FROM messages m
-        INNER JOIN channels c
-            ON m.channel_id = c.id
         INNER JOIN users u
-            ON u.id = m.json_blob->>'user'
-    WHERE c.id = :channel_id
+            ON u.id = m.user_id
+    WHERE m.channel_id = :channel_id
+    AND m.ts >= :first_ts
+    AND m.ts <= :last_ts
     ORDER BY m.ts
     """
 
+sql_load_messages_by_ts = sql_select_messages + """\
+    WHERE m.channel_id = :channel_id
+    AND m.ts IN (SELECT value FROM json_each(:timestamps))
+    ORDER BY m.ts
+    """
+
+sql_load_messages_before = sql_select_messages + """\
+    WHERE m.channel_id = :channel_id
+    AND m.ts < :ts
+    ORDER BY m.ts DESC
+    LIMIT :limit
+    """
+
+sql_load_messages_after = sql_select_messages + """\
+    WHERE m.channel_id = :channel_id
+    AND m.ts > :ts
+    ORDER BY m.ts
+    LIMIT :limit
+    """
+
+sql_load_channel_seq = """\
+    SELECT COALESCE(MAX(seq), 0) FROM messages WHERE channel_id = :channel_id
+    """
+
 
 sql_load_channels = """\
-    SELECT c.id, c.json_blob->>'name' name, c.json_blob->>'user' user_id, c.read
+    SELECT c.id, c.name, c.json_blob->>'user' user_id, c.read
     FROM channels c
         LEFT OUTER JOIN users u
             ON c.json_blob->>'user' = u.id
-            AND c.json_blob->>'is_im' = TRUE
+            AND c.is_im = TRUE
     WHERE (
-        (c.json_blob->>'is_channel' = :is_channel)
+        (c.is_channel = :is_channel)
         OR
-        (c.json_blob->>'is_channel' IS NULL AND :is_channel = FALSE)
+        (c.is_channel IS NULL AND :is_channel = FALSE)
     )
-    AND c.json_blob->>'is_im' = :is_im
-    AND COALESCE(u.json_blob->>'deleted', FALSE) = FALSE
-    AND COALESCE(u.json_blob->>'is_bot', FALSE) = FALSE
-    ORDER BY c.json_blob->>'name'
+    AND c.is_im = :is_im
+    AND COALESCE(u.deleted, FALSE) = FALSE
+    AND COALESCE(u.is_bot, FALSE) = FALSE
+    ORDER BY c.name
     """
 
 sql_load_channel = """\
     SELECT
         id,
-        json_blob->>'is_channel' is_channel,
+        is_channel,
         json_blob->>'is_group' is_group,
-        json_blob->>'is_im' is_im,
+        is_im,
         json_blob->>'is_mpim' is_mpim,
         json_blob->>'is_private' is_private,
-        json_blob->>'name' name
+        name
     FROM channels
     WHERE id = :channel_id
     """
 
+sql_find_channel_id = """\
+    SELECT id FROM channels WHERE name = :name
+    """
+
+sql_load_member_channel_ids = """\
+    SELECT id
+    FROM channels
+    WHERE is_im
+    OR json_blob->>'is_member'
+    ORDER BY name
+    """
+
+sql_find_user_id = """\
+    SELECT id
+    FROM users
+    WHERE name = :name
+    OR display_name = :name
+    ORDER BY name = :name DESC
+    LIMIT 1
+    """
+
+sql_load_users_since = """\
+    SELECT id, name, display_name, deleted, is_bot
+    FROM users
+    WHERE seq > :seq
+    """
+
+sql_load_channels_since = """\
+    SELECT id, name, json_blob->>'user' user_id, is_channel, is_im, read
+    FROM channels
+    WHERE seq > :seq
+    """
+
 sql_load_user = """\
     SELECT
         id,
-        json_blob->>'deleted' deleted,
-        json_blob->>'name' name,
+        deleted,
+        name,
         json_blob->>'$.profile.real_name' real_name,
-        json_blob->>'$.profile.display_name' display_name,
+        display_name,
         json_blob->>'tz' tz,
         json_blob->>'is_admin' is_admin,
-        json_blob->>'is_bot' is_bot
+        is_bot
     FROM users
     WHERE id = :user_id
     """
@@ -452,39 +1595,233 @@ sql_load_user = """\
 sql_load_users = """\
     SELECT
         id,
-        json_blob->>'name' name,
-        json_blob->>'$.profile.display_name' display_name
+        name,
+        display_name
     FROM users
-    ORDER by json_blob->>'name'
+    ORDER by name
     """
 
 sql_insert_file = """\
-    INSERT INTO files(id, timestamp, name, title, mimetype, data)
-        VALUES(:file_id, :timestamp, :name, :title, :mimetype, :data)
+    INSERT INTO files(id, timestamp, name, title, mimetype, sha256, size)
+        VALUES(:file_id, :timestamp, :name, :title, :mimetype, :sha256, :size)
     ON CONFLICT(id) DO UPDATE SET
         timestamp = :timestamp,
         name = :name,
         title = :title,
         mimetype = :mimetype,
-        data = :data
+        sha256 = :sha256,
+        size = :size,
+        data = NULL
+    """
+
+sql_load_file_data = """\
+    SELECT data FROM files WHERE id = :file_id
+    """
+
+sql_move_file_data = """\
+    UPDATE files
+    SET sha256 = :sha256, size = :size, data = NULL
+    WHERE id = :file_id
+    """
+
+sql_upsert_blob = """\
+    INSERT INTO blobs(sha256, size, last_access)
+        VALUES(:sha256, :size, :last_access)
+    ON CONFLICT(sha256) DO UPDATE SET last_access = :last_access
+    """
+
+sql_touch_blob = """\
+    UPDATE blobs SET last_access = :last_access WHERE sha256 = :sha256
+    """
+
+sql_delete_blob = """\
+    DELETE FROM blobs WHERE sha256 = :sha256
     """
 
 sql_insert_message = """\
-    INSERT INTO messages (channel_id, ts, json_blob)
-        VALUES (:channel_id, :ts, jsonb(:message_json))
-    ON CONFLICT(channel_id, ts) DO UPDATE SET json_blob = jsonb(:message_json)
+    INSERT INTO messages (channel_id, ts, json_blob, seq)
+        VALUES (:channel_id, :ts, jsonb(:message_json), :seq)
+    ON CONFLICT(channel_id, ts) DO UPDATE SET
+        json_blob = jsonb(:message_json),
+        seq = :seq
+    """
+
+sql_load_message_json = f"""\
+    SELECT {sql_message_json.strip()}
+    FROM messages m
+    WHERE m.channel_id = :channel_id
+    AND m.ts = :ts
+    """
+
+sql_load_all_message_json = f"""\
+    SELECT m.channel_id, m.ts, {sql_message_json.strip()}
+    FROM messages m
+    """
+
+sql_update_message_digest = """\
+    UPDATE messages
+    SET digest = :digest
+    WHERE channel_id = :channel_id
+    AND ts = :ts
+    """
+
+sql_touch_message = """\
+    UPDATE messages
+    SET seq = :seq
+    WHERE channel_id = :channel_id
+    AND ts = :ts
+    """
+
+sql_insert_reaction = """\
+    INSERT OR IGNORE INTO reactions (channel_id, ts, name, user_id)
+        VALUES (:channel_id, :ts, :name, :user_id)
+    """
+
+sql_insert_reaction_if_message = """\
+    INSERT OR IGNORE INTO reactions (channel_id, ts, name, user_id)
+        SELECT :channel_id, :ts, :name, :user_id
+        WHERE EXISTS (
+            SELECT 1 FROM messages WHERE channel_id = :channel_id AND ts = :ts
+        )
+    """
+
+sql_delete_reaction = """\
+    DELETE FROM reactions
+    WHERE channel_id = :channel_id
+    AND ts = :ts
+    AND name = :name
+    AND user_id = :user_id
+    """
+
+sql_delete_message_reactions = """\
+    DELETE FROM reactions
+    WHERE channel_id = :channel_id
+    AND ts = :ts
+    """
+
+sql_insert_reaction_count = """\
+    INSERT OR REPLACE INTO reaction_counts (channel_id, ts, name, count)
+        VALUES (:channel_id, :ts, :name, :count)
+    """
+
+sql_increment_reaction_count = """\
+    UPDATE reaction_counts
+    SET count = count + 1
+    WHERE channel_id = :channel_id
+    AND ts = :ts
+    AND name = :name
+    """
+
+sql_decrement_reaction_count = """\
+    UPDATE reaction_counts
+    SET count = count - 1
+    WHERE channel_id = :channel_id
+    AND ts = :ts
+    AND name = :name
+    AND count > 0
+    """
+
+sql_delete_message_reaction_counts = """\
+    DELETE FROM reaction_counts
+    WHERE channel_id = :channel_id
+    AND ts = :ts
+    """
+
+sql_upsert_search_doc = """\
+    INSERT INTO search_docs (channel_id, ts)
+        VALUES (:channel_id, :ts)
+    ON CONFLICT(channel_id, ts) DO UPDATE SET ts = excluded.ts
+    RETURNING id
+    """
+
+sql_delete_search_text = """\
+    DELETE FROM messages_fts WHERE rowid = :doc_id
+    """
+
+sql_insert_search_text = """\
+    INSERT INTO messages_fts (rowid, text) VALUES (:doc_id, :text)
+    """
+
+sql_next_seq = """\
+    UPDATE counters
+    SET value = value + 1
+    WHERE name = :name
+    RETURNING value
+    """
+
+sql_load_rendered_message = """\
+    SELECT markup, reactions
+    FROM rendered_messages
+    WHERE digest = :digest
+    AND version = :version
+    """
+
+sql_insert_rendered_message = """\
+    INSERT OR REPLACE INTO rendered_messages (digest, version, markup, reactions)
+    VALUES (:digest, :version, :markup, :reactions)
+    """
+
+sql_insert_rendered_ref = """\
+    INSERT OR IGNORE INTO rendered_refs (ref_id, digest) VALUES (:ref_id, :digest)
+    """
+
+sql_prune_rendered_messages = """\
+    DELETE FROM rendered_messages
+    WHERE id <= (SELECT MAX(id) FROM rendered_messages) - :max_rows
+    """
+
+sql_load_sync_state = """\
+    SELECT oldest_ts, newest_ts, last_sync
+    FROM sync_state
+    WHERE channel_id = :channel_id
+    """
+
+sql_upsert_sync_state = """\
+    INSERT INTO sync_state (channel_id, oldest_ts, newest_ts, last_sync)
+        VALUES (:channel_id, :oldest_ts, :newest_ts, :last_sync)
+    ON CONFLICT(channel_id) DO UPDATE SET
+        oldest_ts = excluded.oldest_ts,
+        newest_ts = excluded.newest_ts,
+        last_sync = excluded.last_sync
+    """
+
+sql_load_counter = """\
+    SELECT value FROM counters WHERE name = :name
+    """
+
+sql_init_counter = """\
+    INSERT OR IGNORE INTO counters(name, value) VALUES (:name, 0)
     """
 
 sql_insert_user = """\
-    INSERT INTO users(id, json_blob)
-        VALUES (:user_id, jsonb(:user_json))
-    ON CONFLICT(id) DO UPDATE SET json_blob = jsonb(:user_json)
+    INSERT INTO users(id, json_blob, json_hash, seq)
+        VALUES (
+            :id,
+            jsonb(:json),
+            :json_hash,
+            (SELECT value + 1 FROM counters WHERE name = 'channels')
+        )
+    ON CONFLICT(id) DO UPDATE SET
+        json_blob = excluded.json_blob,
+        json_hash = excluded.json_hash,
+        seq = excluded.seq
+    WHERE json_hash IS NOT excluded.json_hash
     """
 
 sql_insert_channel = """\
-    INSERT INTO channels(id, read, json_blob)
-        VALUES (:channel_id, FALSE, jsonb(:channel_json))
-    ON CONFLICT(id) DO UPDATE SET json_blob = jsonb(:channel_json)
+    INSERT INTO channels(id, read, json_blob, json_hash, seq)
+        VALUES (
+            :id,
+            FALSE,
+            jsonb(:json),
+            :json_hash,
+            (SELECT value + 1 FROM counters WHERE name = 'channels')
+        )
+    ON CONFLICT(id) DO UPDATE SET
+        json_blob = excluded.json_blob,
+        json_hash = excluded.json_hash,
+        seq = excluded.seq
+    WHERE json_hash IS NOT excluded.json_hash
     """
 
 
@@ -533,3 +1870,281 @@ sql_create_emojis_table = """\
         PRIMARY KEY(short_code)
     )
     """
+
+sql_create_counters_table = """\
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT,
+        value INTEGER NOT NULL,
+        PRIMARY KEY(name)
+    )
+    """
+
+sql_add_message_seq_column = """\
+    ALTER TABLE messages ADD COLUMN seq INTEGER NOT NULL DEFAULT 0
+    """
+
+sql_create_message_seq_index = """\
+    CREATE INDEX IF NOT EXISTS messages_channel_seq ON messages(channel_id, seq)
+    """
+
+sql_add_json_columns = [
+    """\
+    ALTER TABLE messages ADD COLUMN user_id TEXT
+        GENERATED ALWAYS AS (json_blob->>'user') VIRTUAL
+    """,
+    """\
+    ALTER TABLE channels ADD COLUMN name TEXT
+        GENERATED ALWAYS AS (json_blob->>'name') VIRTUAL
+    """,
+    """\
+    ALTER TABLE channels ADD COLUMN is_channel INTEGER
+        GENERATED ALWAYS AS (json_blob->>'is_channel') VIRTUAL
+    """,
+    """\
+    ALTER TABLE channels ADD COLUMN is_im INTEGER
+        GENERATED ALWAYS AS (json_blob->>'is_im') VIRTUAL
+    """,
+    """\
+    ALTER TABLE users ADD COLUMN name TEXT
+        GENERATED ALWAYS AS (json_blob->>'name') VIRTUAL
+    """,
+    """\
+    ALTER TABLE users ADD COLUMN display_name TEXT
+        GENERATED ALWAYS AS (json_blob->>'$.profile.display_name') VIRTUAL
+    """,
+    """\
+    ALTER TABLE users ADD COLUMN deleted INTEGER
+        GENERATED ALWAYS AS (json_blob->>'deleted') VIRTUAL
+    """,
+    """\
+    ALTER TABLE users ADD COLUMN is_bot INTEGER
+        GENERATED ALWAYS AS (json_blob->>'is_bot') VIRTUAL
+    """,
+    """\
+    CREATE INDEX IF NOT EXISTS messages_user ON messages(user_id)
+    """,
+    """\
+    CREATE INDEX IF NOT EXISTS channels_kind_name
+        ON channels(is_im, name, is_channel)
+    """,
+    """\
+    CREATE INDEX IF NOT EXISTS users_name ON users(name, display_name, id)
+    """,
+]
+
+sql_create_reactions_table = """\
+    CREATE TABLE IF NOT EXISTS reactions (
+        channel_id TEXT,
+        ts TEXT,
+        name TEXT,
+        user_id TEXT,
+        PRIMARY KEY (channel_id, ts, name, user_id),
+        FOREIGN KEY (channel_id, ts)
+            REFERENCES messages(channel_id, ts) ON DELETE CASCADE
+    )
+    """
+
+sql_create_reaction_counts_table = """\
+    CREATE TABLE IF NOT EXISTS reaction_counts (
+        channel_id TEXT,
+        ts TEXT,
+        name TEXT,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (channel_id, ts, name),
+        FOREIGN KEY (channel_id, ts)
+            REFERENCES messages(channel_id, ts) ON DELETE CASCADE
+    )
+    """
+
+sql_copy_blob_reactions = """\
+    INSERT OR IGNORE INTO reactions (channel_id, ts, name, user_id)
+    SELECT m.channel_id, m.ts, r.value->>'name', u.value
+    FROM messages m,
+        json_each(m.json_blob, '$.reactions') r,
+        json_each(r.value, '$.users') u
+    """
+
+sql_copy_blob_reaction_counts = """\
+    INSERT OR IGNORE INTO reaction_counts (channel_id, ts, name, count)
+    SELECT m.channel_id, m.ts, r.value->>'name', r.value->>'count'
+    FROM messages m,
+        json_each(m.json_blob, '$.reactions') r
+    WHERE r.value->>'count' IS NOT NULL
+    """
+
+sql_strip_blob_reactions = """\
+    UPDATE messages
+    SET json_blob = jsonb_remove(json_blob, '$.reactions')
+    WHERE json_blob->'reactions' IS NOT NULL
+    """
+
+sql_create_search_docs_table = """\
+    CREATE TABLE IF NOT EXISTS search_docs (
+        id INTEGER PRIMARY KEY,
+        channel_id TEXT,
+        ts TEXT,
+        UNIQUE (channel_id, ts)
+    )
+    """
+
+sql_create_messages_fts_table = """\
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """
+
+sql_create_messages_delete_trigger = """\
+    CREATE TRIGGER IF NOT EXISTS messages_search_delete
+    AFTER DELETE ON messages
+    BEGIN
+        DELETE FROM messages_fts
+        WHERE rowid = (
+            SELECT id FROM search_docs
+            WHERE channel_id = old.channel_id
+            AND ts = old.ts
+        );
+        DELETE FROM search_docs
+        WHERE channel_id = old.channel_id
+        AND ts = old.ts;
+    END
+    """
+
+sql_create_rendered_messages_table = """\
+    CREATE TABLE IF NOT EXISTS rendered_messages (
+        id INTEGER PRIMARY KEY,
+        digest TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        markup TEXT NOT NULL,
+        reactions TEXT,
+        UNIQUE (digest, version)
+    )
+    """
+
+sql_create_rendered_refs_table = """\
+    CREATE TABLE IF NOT EXISTS rendered_refs (
+        ref_id TEXT,
+        digest TEXT,
+        PRIMARY KEY (ref_id, digest)
+    ) WITHOUT ROWID
+    """
+
+sql_create_rendered_refs_digest_index = """\
+    CREATE INDEX IF NOT EXISTS rendered_refs_digest ON rendered_refs(digest)
+    """
+
+sql_create_rendered_messages_delete_trigger = """\
+    CREATE TRIGGER IF NOT EXISTS rendered_messages_delete
+    AFTER DELETE ON rendered_messages
+    WHEN NOT EXISTS (SELECT 1 FROM rendered_messages WHERE digest = old.digest)
+    BEGIN
+        DELETE FROM rendered_refs WHERE digest = old.digest;
+    END
+    """
+
+sql_create_users_rename_trigger = """\
+    CREATE TRIGGER IF NOT EXISTS users_rename_render
+    AFTER UPDATE ON users
+    WHEN old.display_name IS NOT new.display_name
+    BEGIN
+        DELETE FROM rendered_messages
+        WHERE digest IN (SELECT digest FROM rendered_refs WHERE ref_id = new.id);
+    END
+    """
+
+sql_create_channels_rename_trigger = """\
+    CREATE TRIGGER IF NOT EXISTS channels_rename_render
+    AFTER UPDATE ON channels
+    WHEN old.name IS NOT new.name
+    BEGIN
+        DELETE FROM rendered_messages
+        WHERE digest IN (SELECT digest FROM rendered_refs WHERE ref_id = new.id);
+    END
+    """
+
+sql_add_directory_seq_columns = [
+    """\
+    ALTER TABLE users ADD COLUMN seq INTEGER NOT NULL DEFAULT 0
+    """,
+    """\
+    ALTER TABLE channels ADD COLUMN seq INTEGER NOT NULL DEFAULT 0
+    """,
+    """\
+    CREATE INDEX IF NOT EXISTS users_seq ON users(seq)
+    """,
+    """\
+    CREATE INDEX IF NOT EXISTS channels_seq ON channels(seq)
+    """,
+]
+
+sql_add_message_digest_column = """\
+    ALTER TABLE messages ADD COLUMN digest TEXT
+    """
+
+sql_drop_message_seq_index = """\
+    DROP INDEX IF EXISTS messages_channel_seq
+    """
+
+# Covers the refresh query, which reads only the timestamps and digests of
+# changed messages.
+sql_create_message_digest_index = """\
+    CREATE INDEX IF NOT EXISTS messages_channel_seq_digest
+        ON messages(channel_id, seq, ts, digest)
+    """
+
+sql_create_sync_state_table = """\
+    CREATE TABLE IF NOT EXISTS sync_state (
+        channel_id TEXT,
+        oldest_ts TEXT,
+        newest_ts TEXT,
+        last_sync REAL,
+        PRIMARY KEY (channel_id)
+    )
+    """
+
+sql_add_users_json_hash_column = """\
+    ALTER TABLE users ADD COLUMN json_hash TEXT
+    """
+
+sql_add_channels_json_hash_column = """\
+    ALTER TABLE channels ADD COLUMN json_hash TEXT
+    """
+
+sql_create_users_insert_trigger = """\
+    CREATE TRIGGER IF NOT EXISTS users_insert_render
+    AFTER INSERT ON users
+    BEGIN
+        DELETE FROM rendered_messages
+        WHERE digest IN (SELECT digest FROM rendered_refs WHERE ref_id = new.id);
+    END
+    """
+
+sql_create_channels_insert_trigger = """\
+    CREATE TRIGGER IF NOT EXISTS channels_insert_render
+    AFTER INSERT ON channels
+    BEGIN
+        DELETE FROM rendered_messages
+        WHERE digest IN (SELECT digest FROM rendered_refs WHERE ref_id = new.id);
+    END
+    """
+
+sql_create_blobs_table = """\
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT,
+        size INTEGER,
+        last_access REAL,
+        PRIMARY KEY (sha256)
+    )
+    """
+
+sql_create_blobs_access_index = """\
+    CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs(last_access)
+    """
+
+sql_add_files_sha256_column = """\
+    ALTER TABLE files ADD COLUMN sha256 TEXT
+    """
+
+sql_add_files_size_column = """\
+    ALTER TABLE files ADD COLUMN size INTEGER
+    """
@@ -0,0 +1,92 @@
+from collections import namedtuple
+
+from slacktui.database import (load_channels_since, load_counter,
+                               load_users_since)
+
+User = namedtuple("User", ["id", "name", "display_name", "deleted", "is_bot"])
+Channel = namedtuple(
+    "Channel", ["id", "name", "user_id", "is_channel", "is_im", "read"]
+)
+
+_directories = {}
+
+
+def get_directory(workspace):
+    """
+    The shared directory of a workspace.
+    """
+    directory = _directories.get(workspace)
+    if directory is None:
+        directory = Directory(workspace)
+        _directories[workspace] = directory
+    return directory
+
+
+class Directory:
+    """
+    In-memory users and channels of a workspace, keyed by ID.
+
+    Rows are stamped with the `channels` change counter, so `refresh()` only
+    reloads the users and channels changed since the previous refresh and
+    costs a single counter lookup when nothing changed.
+    """
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.users = {}
+        self.channels = {}
+        # Rows start at sequence 0, so the first refresh loads everything.
+        self.seq = -1
+
+    def refresh(self):
+        """
+        Load the users and channels changed since the last refresh.
+        Return True if anything was reloaded.
+        """
+        seq = load_counter(self.workspace, "channels")
+        if seq == self.seq:
+            return False
+        for row in load_users_since(self.workspace, self.seq):
+            self.users[row["id"]] = User(**row)
+        for row in load_channels_since(self.workspace, self.seq):
+            self.channels[row["id"]] = Channel(**row)
+        self.seq = seq
+        return True
+
+    def get_user(self, user_id):
+        """
+        Look up a user, refreshing once if it is not known yet.
+        Return None if there is no such user.
+        """
+        user = self.users.get(user_id)
+        if user is None and self.refresh():
+            user = self.users.get(user_id)
+        return user
+
+    def get_channel(self, channel_id):
+        """
+        Look up a channel, refreshing once if it is not known yet.
+        Return None if there is no such channel.
+        """
+        channel = self.channels.get(channel_id)
+        if channel is None and self.refresh():
+            channel = self.channels.get(channel_id)
+        return channel
+
+    def list_channels(self, load_dms=False):
+        """
+        Channels, or direct messages with active human users, sorted by name.
+        """
+        channels = []
+        for channel in self.channels.values():
+            if load_dms:
+                if channel.is_channel or not channel.is_im:
+                    continue
+                user = self.users.get(channel.user_id)
+                if user is not None and (user.deleted or user.is_bot):
+                    continue
+            elif channel.is_im or not channel.is_channel:
+                continue
+            channels.append(channel)
+        channels.sort(key=lambda channel: channel.name or "")
+        return channels
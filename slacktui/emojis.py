@@ -0,0 +1,191 @@
+import time
+import unicodedata
+from collections import defaultdict
+
+import emoji
+from rich.emoji import Emoji
+
+from slacktui.database import load_emojis, load_reaction_usage
+
+# Longest n-gram indexed for substring search.
+NGRAM_SIZE = 3
+
+# Slack reaction names that differ from the emoji package's names.
+SLACK_ALIASES = {
+    "simple_smile": "\U0001f642",
+}
+
+# `name::skin-tone-N` suffixes and the modifiers they add.
+SKIN_TONES = {
+    "skin-tone-2": "\U0001f3fb",
+    "skin-tone-3": "\U0001f3fc",
+    "skin-tone-4": "\U0001f3fd",
+    "skin-tone-5": "\U0001f3fe",
+    "skin-tone-6": "\U0001f3ff",
+}
+
+_emoji_table = None
+
+
+def get_emoji_table():
+    """
+    The process-wide map of short codes (without colons) to glyphs, built on
+    first use from the emoji package's names and aliases.
+    """
+    global _emoji_table
+    if _emoji_table is None:
+        table = {}
+        for glyph, data in emoji.EMOJI_DATA.items():
+            table[data["en"].strip(":")] = glyph
+            for alias in data.get("alias", []):
+                table[alias.strip(":")] = glyph
+        table.update(SLACK_ALIASES)
+        _emoji_table = table
+    return _emoji_table
+
+
+def add_emojis(emojis):
+    """
+    Add (short code, glyph) pairs to the emoji table.
+    """
+    get_emoji_table().update(emojis)
+
+
+def load_emoji_table(workspace):
+    """
+    Add the workspace's emoji catalog, which uses Slack's short codes, to the
+    emoji table.
+    """
+    add_emojis(load_emojis(workspace))
+
+
+def unified_to_glyph(unified):
+    """
+    Convert dash separated hex code points, e.g. `1f44d-1f3fd`, to a glyph.
+    """
+    return "".join(chr(int(part, 16)) for part in unified.split("-"))
+
+
+def resolve_emoji(code, unified=None):
+    """
+    Glyph for a short code such as `+1`, `:thumbsup:` or
+    `wave::skin-tone-3`.  `unified` gives the code points to use when the
+    code is not known.  Codes that cannot be resolved come back wrapped in
+    colons.
+    """
+    code = code.strip(":")
+    table = get_emoji_table()
+    glyph = table.get(code)
+    if glyph is None:
+        if unified is not None:
+            glyph = unified_to_glyph(unified)
+        else:
+            glyph = _resolve_uncommon(table, code)
+        table[code] = glyph
+    return glyph
+
+
+def _resolve_uncommon(table, code):
+    base, sep, skin_tone = code.partition("::")
+    modifier = SKIN_TONES.get(skin_tone)
+    if sep and modifier is not None and base in table:
+        # Drop any variation selector so the modifier attaches to the base.
+        return table[base].replace("\ufe0f", "") + modifier
+    symbol = Emoji.replace(f":{code}:")
+    if symbol != f":{code}:":
+        return symbol
+    try:
+        return unicodedata.lookup(code)
+    except KeyError:
+        return f":{code}:"
+
+
+_indexes = {}
+
+
+def get_emoji_index(workspace, user_id=None):
+    """
+    The shared emoji search index of a workspace, built on first use.
+    `user_id` is the user whose reaction history ranks the results.
+    """
+    index = _indexes.get(workspace)
+    if index is None:
+        usage = {}
+        if user_id is not None:
+            usage = load_reaction_usage(workspace, user_id)
+        load_emoji_table(workspace)
+        codes = [code for code, glyph in load_emojis(workspace)]
+        index = EmojiIndex(codes, usage)
+        _indexes[workspace] = index
+    return index
+
+
+class EmojiIndex:
+    """
+    In-memory emoji catalog searchable by substring of the short code.
+
+    Every 1- to NGRAM_SIZE-character n-gram of each short code maps to the
+    codes containing it, so a search intersects a few small sets instead of
+    scanning the catalog.  Results rank prefix matches first, then the most
+    recently used, then by short code, and are cached per search text so
+    paging through them is a slice.
+    """
+
+    max_cached_searches = 256
+
+    def __init__(self, codes, usage=None):
+        self.codes = sorted(codes)
+        self.usage = dict(usage or {})
+        self.ngrams = defaultdict(set)
+        for n, code in enumerate(self.codes):
+            for size in range(1, NGRAM_SIZE + 1):
+                for i in range(len(code) - size + 1):
+                    self.ngrams[code[i : i + size]].add(n)
+        self._results = {}
+
+    def search(self, text):
+        """
+        Short codes containing `text`, best matches first.
+        """
+        text = text.strip().strip(":").lower()
+        results = self._results.get(text)
+        if results is None:
+            if len(self._results) >= self.max_cached_searches:
+                self._results.clear()
+            results = self._search(text)
+            self._results[text] = results
+        return results
+
+    def page(self, text, offset, count):
+        """
+        `count` (short code, glyph) pairs of the results for `text`, starting
+        at `offset`.
+        """
+        codes = self.search(text)[offset : offset + count]
+        return [(code, resolve_emoji(code)) for code in codes]
+
+    def record_use(self, code):
+        """
+        Rank `code` as the most recently used emoji.
+        """
+        self.usage[code] = time.time()
+        self._results.clear()
+
+    def _search(self, text):
+        if text == "":
+            candidates = range(len(self.codes))
+        else:
+            size = min(len(text), NGRAM_SIZE)
+            grams = set(text[i : i + size] for i in range(len(text) - size + 1))
+            sets = sorted((self.ngrams.get(gram, set()) for gram in grams), key=len)
+            candidates = set.intersection(*sets)
+            if len(text) > NGRAM_SIZE:
+                candidates = [n for n in candidates if text in self.codes[n]]
+        codes = self.codes
+        usage = self.usage
+
+        def rank(n):
+            code = codes[n]
+            return (not code.startswith(text), -usage.get(code, 0), n)
+
+        return [codes[n] for n in sorted(candidates, key=rank)]
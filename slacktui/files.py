@@ -1,13 +1,115 @@
-from slacktui.database import store_file
+import hashlib
+import threading
+
 import httpx
 
+from slacktui.api import get_client
+from slacktui.database import get_file_store_path, load_file, store_file_blob
+from slacktui.filestore import (CHUNK_SIZE, commit_partial, hash_file,
+                                partial_path)
+from slacktui.ratelimit import INTERACTIVE
+
+MAX_DOWNLOAD_ATTEMPTS = 3
+# Longest edges of the image thumbnails Slack makes, smallest first.
+THUMBNAIL_EDGES = (360, 480, 720, 800, 960, 1024)
+
+_download_locks = {}
+_download_locks_lock = threading.Lock()
+
+
+def get_download_lock(file_id):
+    """
+    Lock held while a file is downloaded, so concurrent workers fetching the
+    same file do not write to the same partial download.
+    """
+    with _download_locks_lock:
+        return _download_locks.setdefault(file_id, threading.Lock())
+
+
+def get_file_data(config, workspace, file_id, on_progress=None):
+    """
+    Download a file into the file store and return it as `load_file` does.
+    `on_progress(received, size)` is called as chunks arrive.
+    Return None if the file could not be retrieved.
+    """
+    with get_download_lock(file_id):
+        # Another worker may have finished the download while this one waited.
+        file_info = load_file(workspace, file_id)
+        if file_info is not None:
+            return file_info
+        file_metadata = get_file_metadata(config, file_id)
+        if file_metadata is None:
+            return None
+        return download_file(
+            config,
+            workspace,
+            file_id,
+            file_metadata["url_private"],
+            file_metadata,
+            size=file_metadata.get("size"),
+            on_progress=on_progress,
+        )
+
+
+def get_preview_data(config, workspace, file_metadata, size, on_progress=None):
+    """
+    Download the smallest of Slack's thumbnails of an image that covers
+    `size` pixels and return it as `load_file` does.  Thumbnails are cached
+    apart from the original under their own key.  Images without thumbnails
+    are previewed from the original.
+    Return None if the image could not be retrieved.
+    """
+    file_id = file_metadata["id"]
+    if "url_private" not in file_metadata:
+        file_metadata = get_file_metadata(config, file_id)
+        if file_metadata is None:
+            return None
+    thumb = choose_thumbnail(file_metadata, size)
+    if thumb is None:
+        return get_file_data(config, workspace, file_id, on_progress)
+    key = f"{file_id}-{thumb}"
+    with get_download_lock(key):
+        file_info = load_file(workspace, key)
+        if file_info is not None:
+            return file_info
+        return download_file(
+            config,
+            workspace,
+            key,
+            file_metadata[thumb],
+            file_metadata,
+            on_progress=on_progress,
+        )
+
+
+def choose_thumbnail(file_metadata, size):
+    """
+    Name of the smallest thumbnail in `file_metadata`, e.g. "thumb_720",
+    that fills a `size` (width, height) box, else the largest one.
+    Return None if the file has no thumbnails.
+    """
+    width, height = size
+    chosen = None
+    for edge in THUMBNAIL_EDGES:
+        thumb = f"thumb_{edge}"
+        if thumb not in file_metadata:
+            continue
+        chosen = thumb
+        thumb_width = file_metadata.get(f"{thumb}_w", edge)
+        thumb_height = file_metadata.get(f"{thumb}_h", edge)
+        if thumb_width >= width or thumb_height >= height:
+            break
+    return chosen
+
 
-def get_file_data(config, workspace, file_id):
-    user_token = config["oauth"]["user_token"]
+def get_file_metadata(config, file_id):
+    """
+    Look up a file's metadata with `files.info`.
+    Return None if the lookup failed.
+    """
+    client = get_client(config)
     params = {"file": file_id}
-    headers = {"Authorization": f"Bearer {user_token}"}
-    url = "https://slack.com/api/files.info"
-    r = httpx.get(url, params=params, headers=headers)
+    r = client.get("files.info", params, priority=INTERACTIVE)
     if r.status_code != 200:
         return None
     json_response = r.json()
@@ -15,29 +117,107 @@ def get_file_data(config, workspace, file_id):
         file_metadata = json_response["file"]
     except KeyError:
         raise
-    private_url = file_metadata["url_private"]
-    r = httpx.get(private_url, headers=headers)
-    if r.status_code != 200:
+    return file_metadata
+
+
+def download_file(
+    config, workspace, key, url, file_metadata, size=None, on_progress=None
+):
+    """
+    Stream `url` into the file store and record it under `key` with the
+    name, title and type from `file_metadata`.
+    """
+    client = get_client(config)
+    root = get_file_store_path(workspace)
+    path = partial_path(root, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    attempt = 1
+    while True:
+        try:
+            result = download(client, url, path, size, on_progress)
+            break
+        except httpx.TransportError as ex:
+            if attempt >= MAX_DOWNLOAD_ATTEMPTS:
+                print(f"Download of file {key} failed: {ex}")
+                return None
+            attempt += 1
+    if result is None:
         return None
-    timestamp = file_metadata["created"]
-    name = file_metadata["name"]
-    mimetype = file_metadata["mimetype"]
-    title = file_metadata.get("title")
-    file_data = r.content
-    store_file(
+    sha256, size = result
+    commit_partial(root, path, sha256)
+    store_file_blob(
         workspace,
-        file_id,
-        file_data,
-        name,
-        timestamp=timestamp,
-        title=title,
-        mimetype=mimetype,
+        key,
+        sha256,
+        size,
+        file_metadata["name"],
+        timestamp=file_metadata["created"],
+        title=file_metadata.get("title"),
+        mimetype=file_metadata["mimetype"],
     )
-    file_info = {
-        "timestamp": timestamp,
-        "name": name,
-        "title": title,
-        "mimetype": mimetype,
-        "data": file_data,
-    }
-    return file_info
+    return load_file(workspace, key)
+
+
+def download(client, url, path, size=None, on_progress=None):
+    """
+    Stream the contents of `url` to the partial download at `path`.  If part
+    of it is already there, only the rest is requested with a Range header;
+    if the rest cannot be requested, the download starts over.
+    `on_progress(received, size)` is called with the bytes already on disk
+    when the transfer starts, then before each chunk is written, so an
+    exception raised from it to abandon the download leaves only the chunks
+    before it, never a finished download that was not committed.
+    Return the SHA-256 digest and size of the finished download, or None if
+    the server refused the request.
+    """
+    received = path.stat().st_size if path.exists() else 0
+    headers = None
+    if received > 0:
+        headers = {"Range": f"bytes={received}-"}
+    with client.stream(url, headers=headers) as r:
+        if r.status_code == 206:
+            mode = "ab"
+            sha256 = hash_file(path)
+        elif r.status_code == 200:
+            mode = "wb"
+            sha256 = hashlib.sha256()
+            received = 0
+        else:
+            mode = None
+        if mode is not None:
+            if on_progress is not None:
+                on_progress(received, size)
+            with open(path, mode) as f:
+                for chunk in r.iter_bytes(CHUNK_SIZE):
+                    received += len(chunk)
+                    if on_progress is not None:
+                        on_progress(received, size)
+                    f.write(chunk)
+                    sha256.update(chunk)
+            return sha256.hexdigest(), received
+        length = get_range_length(r.headers.get("Content-Range"))
+    if received == 0:
+        return None
+    if length is None:
+        length = received if size is None else size
+    if r.status_code == 416 and length == received:
+        # Nothing is left past the end of the partial download, and its
+        # length agrees with the server's, so it is complete.
+        return hash_file(path).hexdigest(), received
+    # The partial download cannot be resumed; start over without it.
+    path.unlink()
+    return download(client, url, path, size, on_progress)
+
+
+def get_range_length(content_range):
+    """
+    The complete length in a `Content-Range` header such as "bytes */1234",
+    or None if it is missing or unknown.
+    """
+    if content_range is None:
+        return None
+    _, _, length = content_range.rpartition("/")
+    try:
+        return int(length)
+    except ValueError:
+        return None
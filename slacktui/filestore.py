@@ -0,0 +1,109 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+
+CHUNK_SIZE = 64 * 1024
+
+
+def blob_path(root, sha256):
+    """
+    Path of the blob with digest `sha256` in the store at `root`.
+    """
+    return root / sha256[:2] / sha256
+
+
+def write_blob(root, data):
+    """
+    Write `data` to the content-addressed store at `root`.
+    Return its SHA-256 hex digest.
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = blob_path(root, sha256)
+    if path.exists():
+        return sha256
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_name, path)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+    return sha256
+
+
+def partial_path(root, key):
+    """
+    Path of the unfinished download identified by `key` in the store at
+    `root`.
+    """
+    return root / "partial" / f"{key}.part"
+
+
+def delete_stale_partials(root, max_age):
+    """
+    Delete the unfinished downloads in the store at `root` that have not been
+    written to for `max_age` seconds.
+    Return the number of bytes deleted.
+    """
+    cutoff = time.time() - max_age
+    deleted = 0
+    for path in (root / "partial").glob("*.part"):
+        try:
+            stat = path.stat()
+            if stat.st_mtime >= cutoff:
+                continue
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        deleted += stat.st_size
+    return deleted
+
+
+def hash_file(path):
+    """
+    A running SHA-256 hash of the contents of the file at `path`.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256
+
+
+def commit_partial(root, path, sha256):
+    """
+    Move a finished download with digest `sha256` into the store at `root`.
+    """
+    dest = blob_path(root, sha256)
+    if dest.exists():
+        path.unlink()
+        return
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(path, dest)
+
+
+def read_blob(root, sha256):
+    """
+    Memory-map a blob read-only.
+    Return None if the blob is not in the store.
+    """
+    path = blob_path(root, sha256)
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+
+
+def delete_blob(root, sha256):
+    path = blob_path(root, sha256)
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
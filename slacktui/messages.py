@@ -1,7 +1,7 @@
-import datetime
 import json
 
-import httpx
+from slacktui.api import get_client
+from slacktui.ratelimit import INTERACTIVE
 
 
 def message_transform(message):
@@ -26,16 +26,13 @@ def post_message(config, channel_id, text, thread_ts=None):
     """
     Post a text message to a channel.
     """
-    url = "https://slack.com/api/chat.postMessage"
-    user_token = config["oauth"]["user_token"]
-    headers = {"Authorization": f"Bearer {user_token}"}
     params = {
         "channel": channel_id,
         "text": text,
     }
     if thread_ts:
         params["thread_ts"] = thread_ts
-    r = httpx.post(url, headers=headers, params=params)
+    r = get_client(config).post("chat.postMessage", params, priority=INTERACTIVE)
     if r.status_code != 200:
         print(
             f"Got status {r.status_code} when posting"
@@ -47,41 +44,70 @@ def post_message(config, channel_id, text, thread_ts=None):
         print(json.dumps(json_response, indent=4))
 
 
-def get_history_for_channel(config, channel_id, days):
+def get_history_for_channel(config, channel_id, oldest, latest=None):
     """
-    Generator produces `days` days worth of history from the channel specified
-    by channel ID.
+    Generator produces the messages of the channel specified by channel ID
+    posted after `oldest` and, if given, before `latest`, newest first.
     """
-    user_token = config["oauth"]["user_token"]
-    headers = {"Authorization": f"Bearer {user_token}"}
-    url = "https://slack.com/api/conversations.history"
-    ts = (datetime.datetime.today() - datetime.timedelta(days)).timestamp()
-    params = {"channel": channel_id, "limit": 100, "oldest": ts}
-    for json_response in page_results(httpx.get, url, params=params, headers=headers):
+    params = {"channel": channel_id, "limit": 100, "oldest": oldest}
+    if latest is not None:
+        params["latest"] = latest
+    client = get_client(config)
+    for json_response in page_results(client, "conversations.history", params):
         messages = json_response["messages"]
-        messages.reverse()
         for message in messages:
             yield message_transform(message)
 
 
-def page_results(request_func, url, params, headers):
+async def aget_history_pages(config, channel_id, oldest, latest=None, page_size=200):
+    """
+    Async generator produces the messages of the channel specified by
+    channel ID posted after `oldest` and, if given, before `latest`, one page
+    at a time, newest first.
+    Raises ValueError if Slack reports an error, e.g. `not_in_channel`.
+    """
+    params = {"channel": channel_id, "limit": page_size, "oldest": oldest}
+    if latest is not None:
+        params["latest"] = latest
+    client = get_client(config)
+    async for json_response in apage_results(client, "conversations.history", params):
+        if not json_response.get("ok", True):
+            raise ValueError(json_response.get("error"))
+        yield [message_transform(message) for message in json_response["messages"]]
+
+
+def page_results(client, method, params):
     """
     Generator pages results for web API requests.
     """
     orig_params = dict(params)
     while True:
-        r = request_func(url, params=params, headers=headers)
+        r = client.get(method, params)
+        r.raise_for_status()
+        json_response = r.json()
+        yield json_response
+        # The last page has an empty or missing `next_cursor`.
+        response_metadata = json_response.get("response_metadata", {})
+        cursor = response_metadata.get("next_cursor")
+        if not cursor:
+            break
+        params = dict(orig_params)
+        params["cursor"] = cursor
+
+
+async def apage_results(client, method, params):
+    """
+    Async generator pages results for web API requests.
+    """
+    orig_params = dict(params)
+    while True:
+        r = await client.aget(method, params)
         r.raise_for_status()
         json_response = r.json()
         yield json_response
-        has_more = json_response.get("has_more", False)
-        if not has_more:
+        response_metadata = json_response.get("response_metadata", {})
+        cursor = response_metadata.get("next_cursor")
+        if not cursor:
             break
-        response_metadata = json_response["response_metadata"]
-        try:
-            cursor = response_metadata["next_cursor"]
-        except KeyError:
-            print(json.dumps(response_metadata, indent=4))
-            raise
         params = dict(orig_params)
         params["cursor"] = cursor
@@ -0,0 +1,172 @@
+import itertools
+import queue
+import threading
+import time
+
+from slacktui.database import close_connections
+from slacktui.files import get_preview_data
+
+DEFAULT_PREFETCH_WORKERS = 2
+DEFAULT_PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+# Preview size used when none is given.
+DEFAULT_PREVIEW_SIZE = (1024, 1024)
+
+
+class PrefetchCancelled(Exception):
+    """
+    Raised from a download's progress callback to abandon it before the
+    next chunk is written.  The partial download is kept and resumed the
+    next time the file is fetched.
+    """
+
+
+class Prefetcher:
+    """
+    Worker threads that download image previews before they are viewed.
+
+    Files are queued with a rank (lower is fetched first) and fetched in
+    rank order, then in the order they were queued.  At most `max_bytes`
+    are downloaded after each `reset()`, or per `budget_interval` seconds
+    if that is set.  `reset()` drops the queue and abandons the downloads
+    in progress, e.g. when the user switches channels.  If `thumbnails` is
+    a `ThumbnailCache`, the previews are also decoded into it.
+    """
+
+    def __init__(
+        self,
+        config,
+        workspace,
+        workers=DEFAULT_PREFETCH_WORKERS,
+        max_bytes=DEFAULT_PREFETCH_MAX_BYTES,
+        budget_interval=None,
+        size=DEFAULT_PREVIEW_SIZE,
+        thumbnails=None,
+    ):
+        self.config = config
+        self.workspace = workspace
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.budget_interval = budget_interval
+        self.size = size
+        self.thumbnails = thumbnails
+        self.generation = 0
+        self.spent = 0
+        self.budget_start = time.monotonic()
+        self.queued = set()
+        self.fetched = 0
+        self.fetched_bytes = 0
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(
+                target=self.run, name=f"prefetch-{n}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Drop queued files and signal the workers to exit.
+        """
+        self.reset()
+        for thread in self._threads:
+            self._queue.put((float("inf"), next(self._counter), None, None))
+        self._threads = []
+
+    def stats(self):
+        return {"fetched": self.fetched, "bytes": self.fetched_bytes}
+
+    def reset(self, size=None):
+        """
+        Drop queued files, abandon downloads in progress and restore the
+        byte budget.  `size` replaces the preview size.
+        """
+        with self._lock:
+            self.generation += 1
+            self.spent = 0
+            self.budget_start = time.monotonic()
+            self.queued.clear()
+            if size is not None:
+                self.size = size
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def add(self, files, rank=0):
+        """
+        Queue the image files of a message.
+        """
+        with self._lock:
+            generation = self.generation
+            for file in files:
+                if not file.get("mimetype", "").startswith("image/"):
+                    continue
+                if file["id"] in self.queued:
+                    continue
+                self.queued.add(file["id"])
+                item = (rank, next(self._counter), generation, file)
+                self._queue.put(item)
+
+    def run(self):
+        while True:
+            rank, _, generation, file = self._queue.get()
+            if file is None:
+                break
+            try:
+                self.prefetch(generation, file)
+            except PrefetchCancelled:
+                pass
+            except Exception as ex:
+                print(f"Could not prefetch file {file['id']}: {ex}")
+        close_connections()
+
+    def has_budget(self, generation, pending=0):
+        with self._lock:
+            if generation != self.generation:
+                return False
+            now = time.monotonic()
+            if self.budget_interval and now - self.budget_start > self.budget_interval:
+                self.spent = 0
+                self.budget_start = now
+            return self.spent + pending < self.max_bytes
+
+    def prefetch(self, generation, file):
+        if not self.has_budget(generation):
+            return
+        size = self.size
+        received = 0
+        last = None
+
+        def on_progress(count, total):
+            # `count` includes the bytes of a resumed partial download, which
+            # were charged when they were fetched.  Each transfer reports its
+            # starting count first, so only the increases are new bytes.
+            nonlocal received, last
+            if last is not None:
+                received += max(count - last, 0)
+            last = count
+            if not self.has_budget(generation, received):
+                raise PrefetchCancelled()
+
+        try:
+            file_info = get_preview_data(
+                self.config, self.workspace, file, size, on_progress=on_progress
+            )
+        finally:
+            with self._lock:
+                self.spent += received
+                self.fetched_bytes += received
+        if file_info is None:
+            return
+        if received > 0:
+            with self._lock:
+                self.fetched += 1
+        if self.thumbnails is not None:
+            if self.thumbnails.get(file["id"], size) is None:
+                self.thumbnails.put(file["id"], size, file_info["data"])
@@ -0,0 +1,161 @@
+import asyncio
+import random
+import threading
+import time
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Requests per minute allowed by each Slack rate limit tier.
+TIER_LIMITS = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100,
+}
+
+# Tier of each Web API method the package calls.  `chat.postMessage` is
+# limited to about one message per second rather than by tier.
+METHOD_TIERS = {
+    "auth.test": 4,
+    "conversations.history": 3,
+    "conversations.list": 2,
+    "files.info": 4,
+    "reactions.add": 3,
+    "reactions.get": 3,
+    "reactions.remove": 2,
+    "users.list": 2,
+}
+METHOD_LIMITS = {
+    "chat.postMessage": 60,
+}
+DEFAULT_TIER = 3
+
+# Share of each bucket that background requests leave for interactive ones.
+INTERACTIVE_RESERVE = 0.2
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second up to `capacity`.
+
+    Background requests may not take the last `reserve` tokens, so posting
+    and reacting stay responsive while a backfill keeps the bucket drained.
+    `pause()` stops the bucket from handing out tokens until a time, e.g.
+    after a 429 response.
+    """
+
+    def __init__(self, capacity, rate, reserve=0):
+        self.capacity = capacity
+        self.rate = rate
+        # A background request must still fit in a full bucket.
+        self.reserve = max(0, min(reserve, capacity - 1))
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def take(self, priority=BACKGROUND):
+        """
+        Take a token if one is available to `priority`.
+        Return 0 on success, otherwise the seconds to wait before retrying.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+            needed = 1
+            if priority != INTERACTIVE:
+                needed += self.reserve
+            if self.tokens >= needed:
+                self.tokens -= 1
+                return 0
+            return (needed - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Per-method token buckets sized from Slack's rate limit tiers, plus
+    counters of delayed, throttled (429) and retried requests.
+    """
+
+    def __init__(self, max_retries=5, max_jitter=1.0):
+        self.max_retries = max_retries
+        self.max_jitter = max_jitter
+        self.delayed = 0
+        self.throttled = 0
+        self.retried = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {
+            "delayed": self.delayed,
+            "throttled": self.throttled,
+            "retried": self.retried,
+        }
+
+    def get_bucket(self, method):
+        with self._lock:
+            bucket = self._buckets.get(method)
+            if bucket is None:
+                per_minute = METHOD_LIMITS.get(method)
+                if per_minute is None:
+                    tier = METHOD_TIERS.get(method, DEFAULT_TIER)
+                    per_minute = TIER_LIMITS[tier]
+                bucket = TokenBucket(
+                    per_minute,
+                    per_minute / 60,
+                    reserve=per_minute * INTERACTIVE_RESERVE,
+                )
+                self._buckets[method] = bucket
+            return bucket
+
+    def wait(self, method, priority=BACKGROUND):
+        """
+        Block until `method` may be called.
+        """
+        bucket = self.get_bucket(method)
+        delay = bucket.take(priority)
+        if delay > 0:
+            self.delayed += 1
+        while delay > 0:
+            time.sleep(delay)
+            delay = bucket.take(priority)
+
+    async def async_wait(self, method, priority=BACKGROUND):
+        """
+        Wait without blocking the event loop until `method` may be called.
+        """
+        bucket = self.get_bucket(method)
+        delay = bucket.take(priority)
+        if delay > 0:
+            self.delayed += 1
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = bucket.take(priority)
+
+    def throttle(self, method, response, attempt):
+        """
+        Record a 429 response to `method` and pause its bucket for the
+        response's Retry-After plus jitter.
+        Return True if the request should be retried.
+        """
+        self.throttled += 1
+        try:
+            retry_after = float(response.headers.get("Retry-After", 1))
+        except ValueError:
+            retry_after = 1.0
+        delay = retry_after + random.uniform(0, self.max_jitter)
+        self.get_bucket(method).pause(delay)
+        if attempt >= self.max_retries:
+            return False
+        self.retried += 1
+        return True
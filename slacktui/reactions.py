@@ -1,21 +1,19 @@
 import json
 
-import httpx
+from slacktui.api import get_client
+from slacktui.ratelimit import INTERACTIVE
 
 
 def add_reaction(config, channel_id, ts, reaction):
     """
     Add a reaction to a message.
     """
-    url = "https://slack.com/api/reactions.add"
-    user_token = config["oauth"]["user_token"]
-    headers = {"Authorization": f"Bearer {user_token}"}
     params = {
         "channel": channel_id,
         "name": reaction,
         "timestamp": ts,
     }
-    r = httpx.post(url, headers=headers, params=params)
+    r = get_client(config).post("reactions.add", params, priority=INTERACTIVE)
     if r.status_code != 200:
         print(
             f"Got status {r.status_code} when reacting"
@@ -31,15 +29,12 @@ def remove_reaction(config, channel_id, ts, reaction):
     """
     Remove a reaction from a message.
     """
-    url = "https://slack.com/api/reactions.remove"
-    user_token = config["oauth"]["user_token"]
-    headers = {"Authorization": f"Bearer {user_token}"}
     params = {
         "channel": channel_id,
         "name": reaction,
         "timestamp": ts,
     }
-    r = httpx.post(url, headers=headers, params=params)
+    r = get_client(config).post("reactions.remove", params, priority=INTERACTIVE)
     if r.status_code != 200:
         print(
             f"Got status {r.status_code} when removing reaction {reaction}"
@@ -55,14 +50,11 @@ def fetch_reactions_for_message(config, channel_id, ts):
     """
     Fetch reactions to a message.
     """
-    url = "https://slack.com/api/reactions.get"
-    user_token = config["oauth"]["user_token"]
-    headers = {"Authorization": f"Bearer {user_token}"}
     params = {
         "channel": channel_id,
         "timestamp": ts,
     }
-    r = httpx.post(url, headers=headers, params=params)
+    r = get_client(config).post("reactions.get", params, priority=INTERACTIVE)
     if r.status_code != 200:
         print(
             f"Got status {r.status_code} when fetching reactions for message"
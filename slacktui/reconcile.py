@@ -0,0 +1,35 @@
+def diff_keyed(current, desired):
+    """
+    Compare two lists of (key, digest) pairs that are both in key order.
+
+    Return the keys of `current` missing from `desired`, the keys whose
+    digests differ, and the runs of keys only in `desired` as
+    (position, keys) pairs.  Each run belongs before the item at
+    `position` among the kept items of `current`, or after the last one
+    when `position` equals their count.
+    """
+    desired_digests = dict(desired)
+    removed = []
+    changed = []
+    kept = {}
+    for key, digest in current:
+        if key not in desired_digests:
+            removed.append(key)
+            continue
+        kept[key] = len(kept)
+        if desired_digests[key] != digest:
+            changed.append(key)
+    inserted = []
+    position = 0
+    run = []
+    for key, _ in desired:
+        if key in kept:
+            if run:
+                inserted.append((position, run))
+                run = []
+            position = kept[key] + 1
+            continue
+        run.append(key)
+    if run:
+        inserted.append((position, run))
+    return removed, changed, inserted
@@ -0,0 +1,113 @@
+import time
+
+from slacktui.database import load_sync_state, store_history
+from slacktui.messages import aget_history_pages, get_history_for_channel
+
+
+def sync_channel_history(config, workspace, channel_id, days, fill_gaps=True):
+    """
+    Fetch the messages of a channel that are not yet in the database.
+
+    Only messages newer than the newest synced message are requested.  If
+    `fill_gaps` is set and the synced history does not yet reach back `days`
+    days, the span between the horizon and the oldest synced message is
+    fetched as well.  Returns the number of messages stored.
+    """
+    horizon = get_horizon(days)
+    state = load_sync_state(workspace, channel_id)
+    if state is None:
+        messages = list(get_history_for_channel(config, channel_id, horizon))
+        oldest_ts = horizon
+        newest_ts = horizon
+    else:
+        messages = list(get_history_for_channel(config, channel_id, state["newest_ts"]))
+        oldest_ts = state["oldest_ts"]
+        newest_ts = state["newest_ts"]
+        if fill_gaps and float(horizon) < float(oldest_ts):
+            messages.extend(
+                get_history_for_channel(config, channel_id, horizon, latest=oldest_ts)
+            )
+            oldest_ts = horizon
+    return store_page(workspace, channel_id, messages, oldest_ts, newest_ts)
+
+
+async def abackfill_channel(config, workspace, channel_id, days, on_page=None):
+    """
+    Fetch `days` days of a channel's history, newest first.
+
+    The sync state is checkpointed with every page, so an interrupted
+    backfill resumes below the oldest page it stored.  Messages newer than
+    the high-water mark of an earlier sync are caught up first.
+    `on_page(channel_id, count)` is called after each page is stored.
+    Returns the number of messages stored.
+    """
+    horizon = get_horizon(days)
+    state = load_sync_state(workspace, channel_id)
+    total = 0
+    if state is None:
+        oldest_ts = None
+        newest_ts = None
+    else:
+        oldest_ts = state["oldest_ts"]
+        newest_ts = state["newest_ts"]
+        # Pages of newer messages are stored together so the synced span
+        # never has a hole in it.
+        messages = []
+        async for page in aget_history_pages(config, channel_id, newest_ts):
+            messages.extend(page)
+        if messages:
+            total += store_page(workspace, channel_id, messages, oldest_ts, newest_ts)
+            newest_ts = max_ts(messages, newest_ts)
+            if on_page is not None:
+                on_page(channel_id, len(messages))
+        if float(horizon) >= float(oldest_ts):
+            return total
+    async for page in aget_history_pages(config, channel_id, horizon, latest=oldest_ts):
+        if not page:
+            continue
+        if newest_ts is None:
+            newest_ts = max_ts(page, horizon)
+        oldest_ts = min_ts(page, oldest_ts)
+        total += store_page(workspace, channel_id, page, oldest_ts, newest_ts)
+        if on_page is not None:
+            on_page(channel_id, len(page))
+    store_history(workspace, channel_id, [], horizon, newest_ts or horizon)
+    return total
+
+
+def store_page(workspace, channel_id, messages, oldest_ts, newest_ts):
+    """
+    Store a page of a channel's messages along with its sync state.
+    """
+    for message in messages:
+        message["channel"] = channel_id
+    newest_ts = max_ts(messages, newest_ts)
+    store_history(workspace, channel_id, messages, oldest_ts, newest_ts)
+    return len(messages)
+
+
+def get_horizon(days):
+    """
+    The timestamp `days` days ago.
+    """
+    return f"{time.time() - days * 86400:.6f}"
+
+
+def max_ts(messages, default):
+    """
+    The newest timestamp among `messages` and `default`, which may be None.
+    """
+    timestamps = [message["ts"] for message in messages]
+    if default is not None:
+        timestamps.append(default)
+    return max(timestamps, key=float, default=default)
+
+
+def min_ts(messages, default):
+    """
+    The oldest timestamp among `messages` and `default`, which may be None.
+    """
+    timestamps = [message["ts"] for message in messages]
+    if default is not None:
+        timestamps.append(default)
+    return min(timestamps, key=float, default=default)
@@ -1,7 +1,70 @@
 from rich import inspect
 from rich.markup import escape
 
-from slacktui.database import load_channel, load_user
+from slacktui.database import load_rendered_message, store_rendered_message
+from slacktui.directory import get_directory
+from slacktui.emojis import resolve_emoji
+
+# Bump when the markup produced for a message changes so cached renderings
+# are ignored.
+RENDERER_VERSION = 2
+
+
+def render_message(workspace, message, digest, writer=None):
+    """
+    Render a message's text and reaction summary.
+    Renderings are cached in the DB by message `digest` and renderer version.
+    If `writer` is a `WriteQueue`, new renderings are cached through it
+    rather than written by the caller.
+    Return a dict with `markup` and `reactions` (None if there are none).
+    """
+    rendered = load_rendered_message(workspace, digest, RENDERER_VERSION)
+    if rendered is not None:
+        return rendered
+    markup = format_text_item(workspace, message)
+    reactions = format_reactions(message.get("reactions"))
+    refs = collect_refs(message.get("blocks", []))
+    args = (digest, RENDERER_VERSION, markup, reactions, refs)
+    if writer is None:
+        store_rendered_message(workspace, *args)
+    else:
+        writer.offer(store_rendered_message, *args)
+    return {"markup": markup, "reactions": reactions}
+
+
+def format_reactions(reactions):
+    """
+    Summarize reactions as a line of emoji counts and a tooltip.
+    """
+    if reactions is None:
+        return None
+    symbols = []
+    reaction_names = []
+    for reaction in reactions:
+        react_name = reaction["name"]
+        react_count = reaction["count"]
+        emoji_symbol = resolve_emoji(react_name)
+        symbols.append(f"{emoji_symbol}x{react_count}")
+        reaction_names.append(react_name)
+    return {
+        "text": " ".join(symbols),
+        "tooltip": f"Reactions: {', '.join(reaction_names)}",
+    }
+
+
+def collect_refs(elements):
+    """
+    IDs of the users and channels mentioned in message blocks.
+    """
+    refs = set()
+    for element in elements:
+        elm_type = element.get("type")
+        if elm_type == "user":
+            refs.add(element["user_id"])
+        elif elm_type == "channel":
+            refs.add(element["channel_id"])
+        refs.update(collect_refs(element.get("elements", [])))
+    return refs
 
 
 def format_text_item(workspace, item):
@@ -96,11 +159,11 @@ def construct_channel(workspace, element):
     Construct a channel from a message element.
     """
     channel_id = element["channel_id"]
-    channel_info = load_channel(workspace, channel_id)
+    channel_info = get_directory(workspace).get_channel(channel_id)
     if channel_info is None:
         channel = channel_id
     else:
-        channel = channel_info["name"]
+        channel = channel_info.name
     return f"[$text-accent]#{escape(channel)}[/]"
 
 
@@ -109,11 +172,11 @@ def construct_user(workspace, element):
     Construct a user from a message element.
     """
     user_id = element["user_id"]
-    user_info = load_user(workspace, user_id)
+    user_info = get_directory(workspace).get_user(user_id)
     if user_info is None:
         username = user_id
     else:
-        username = user_info["display_name"]
+        username = user_info.display_name
     return f"[$text-accent]@{escape(username)}[/]"
 
 
@@ -121,9 +184,8 @@ def construct_emoji(element):
     """
     Construct an emoji from `element`.
     """
-    unicode_hex = element.get("unicode")
-    if unicode_hex is None:
-        return f":{element['name']}:"
-    hexes = unicode_hex.split("-")
-    parts = [chr(int(code, 16)) for code in hexes]
-    return "".join(parts)
+    name = element["name"]
+    skin_tone = element.get("skin_tone")
+    if skin_tone is not None:
+        name = f"{name}::skin-tone-{skin_tone}"
+    return resolve_emoji(name, element.get("unicode"))
@@ -0,0 +1,167 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from slacktui.database import get_file_store_path
+
+try:
+    from textual_image._terminal import get_cell_size
+except ImportError:
+    get_cell_size = None
+
+# Pixel size of a terminal cell when the terminal does not report it.
+DEFAULT_CELL_SIZE = (10, 20)
+# Thumbnail sizes are rounded up to this many pixels, so small terminal
+# resizes reuse the thumbnails already made.
+SIZE_STEP = 128
+MAX_MEMORY_THUMBNAILS = 32
+MAX_DISK_THUMBNAILS = 2000
+
+_caches = {}
+
+
+def get_thumbnail_cache(workspace):
+    """
+    The shared thumbnail cache of a workspace.
+    """
+    cache = _caches.get(workspace)
+    if cache is None:
+        cache = ThumbnailCache(get_file_store_path(workspace) / "thumbs")
+        _caches[workspace] = cache
+    return cache
+
+
+def get_thumbnail_size(columns, rows):
+    """
+    Pixel size of a thumbnail that fills `columns` by `rows` terminal cells.
+    """
+    cell_size = None
+    if get_cell_size is not None:
+        try:
+            cell_size = get_cell_size()
+        except Exception:
+            pass
+    if cell_size is None:
+        cell_size = DEFAULT_CELL_SIZE
+    width = columns * cell_size[0]
+    height = rows * cell_size[1]
+    return (round_up(width, SIZE_STEP), round_up(height, SIZE_STEP))
+
+
+def get_terminal_thumbnail_size():
+    """
+    Size of a thumbnail that fills the terminal this process runs in, which
+    is the size the TUI makes for the same terminal.  Lets a process without
+    a UI, like the collector, make thumbnails the TUI will find.
+    """
+    columns, rows = shutil.get_terminal_size()
+    return get_thumbnail_size(columns, rows)
+
+
+def round_up(value, step):
+    return max(step, -(-value // step) * step)
+
+
+def make_thumbnail(data, size):
+    """
+    Decode image `data` and scale it down to fit within `size` pixels.
+    """
+    image = Image.open(io.BytesIO(data))
+    # JPEG images can be decoded at a fraction of their size directly.
+    image.draft("RGB", size)
+    image.thumbnail(size)
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA")
+    return image
+
+
+class ThumbnailCache:
+    """
+    Downscaled images keyed by file ID and size, kept in a bounded in-memory
+    LRU in front of compact thumbnail files on disk.  Safe to use from
+    worker threads.
+    """
+
+    def __init__(
+        self, root, max_memory=MAX_MEMORY_THUMBNAILS, max_disk=MAX_DISK_THUMBNAILS
+    ):
+        self.root = root
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_id, size):
+        """
+        A cached thumbnail, or None if there is none of this size yet.
+        """
+        key = (file_id, size)
+        with self._lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                return image
+        for path in self.paths(file_id, size):
+            try:
+                image = Image.open(path)
+                image.load()
+            except FileNotFoundError:
+                continue
+            self.remember(key, image)
+            return image
+        return None
+
+    def put(self, file_id, size, data):
+        """
+        Make a thumbnail of image `data`, cache it and return it.
+        """
+        image = make_thumbnail(data, size)
+        jpeg_path, png_path = self.paths(file_id, size)
+        self.root.mkdir(parents=True, exist_ok=True)
+        if image.mode in ("RGB", "L"):
+            path = jpeg_path
+            options = {"format": "JPEG", "quality": 85}
+        else:
+            path = png_path
+            options = {"format": "PNG"}
+        fd, temp_name = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, **options)
+            os.replace(temp_name, path)
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+        self.remember((file_id, size), image)
+        self.prune()
+        return image
+
+    def paths(self, file_id, size):
+        name = f"{file_id}-{size[0]}x{size[1]}"
+        return (self.root / f"{name}.jpg", self.root / f"{name}.png")
+
+    def remember(self, key, image):
+        with self._lock:
+            self.images[key] = image
+            self.images.move_to_end(key)
+            while len(self.images) > self.max_memory:
+                self.images.popitem(last=False)
+
+    def prune(self):
+        """
+        Delete the oldest thumbnail files beyond `max_disk`.
+        """
+        entries = list(os.scandir(self.root))
+        if len(entries) <= self.max_disk:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[: len(entries) - self.max_disk]:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
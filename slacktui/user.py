@@ -1,32 +1,28 @@
-import httpx
+from slacktui.api import get_client
+from slacktui.messages import page_results
+from slacktui.ratelimit import INTERACTIVE
 
 
-def query_users(config):
+def query_users(config, page_size=1000):
     """
     Generator queries users and produces entries corresponding to each one.
     """
-    url = "https://slack.com/api/users.list"
-    user_token = config["oauth"]["user_token"]
-    headers = {"Authorization": f"Bearer {user_token}"}
-    params = {"types": "public_channel,private_channel"}
-    response = httpx.get(url, headers=headers, params=params)
-    json_response = response.json()
-    try:
-        users = json_response["members"]
-    except KeyError:
-        raise
-    for user in users:
-        yield user
+    params = {"limit": page_size}
+    client = get_client(config)
+    for json_response in page_results(client, "users.list", params):
+        try:
+            users = json_response["members"]
+        except KeyError:
+            raise
+        for user in users:
+            yield user
 
 
 def get_authenticated_user(config):
     """
     Gets the authenticated user's identity.
     """
-    url = "https://slack.com/api/auth.test"
-    user_token = config["oauth"]["user_token"]
-    headers = {"Authorization": f"Bearer {user_token}"}
-    response = httpx.get(url, headers=headers)
+    response = get_client(config).get("auth.test", priority=INTERACTIVE)
     if response.status_code != 200:
         print(
             f"Received HTTP status {response.status_code} while trying to"
@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+import traceback
+
+from slacktui.database import close_connections, transaction
+
+_STOP = object()
+
+
+class WriteQueue:
+    """
+    Bounded queue of database writes applied by a single writer thread.
+
+    Each queued write is a function that takes the workspace as its first
+    argument, e.g. `store_message`.  Writes are grouped into one transaction
+    per `batch_size` writes or `flush_interval` seconds, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        workspace,
+        max_size=10000,
+        batch_size=200,
+        flush_interval=0.05,
+        on_flush=None,
+    ):
+        self.workspace = workspace
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.flushed_batches = 0
+        self.flushed_writes = 0
+        self.failed_writes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._queue = queue.Queue(maxsize=max_size)
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+
+    @property
+    def depth(self):
+        """
+        Number of writes waiting to be flushed.
+        """
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "flushed_batches": self.flushed_batches,
+            "flushed_writes": self.flushed_writes,
+            "failed_writes": self.failed_writes,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, func, *args):
+        """
+        Queue a write.  Blocks while the queue is full.
+        """
+        self._queue.put((func, args))
+
+    def offer(self, func, *args):
+        """
+        Queue a write unless the queue is full.
+        Return False if the write was dropped.
+        """
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Flush all queued writes and stop the writer thread.
+        """
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        close_connections()
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        try:
+            with transaction(self.workspace):
+                for func, args in batch:
+                    func(self.workspace, *args)
+        except Exception:
+            # Retry one write per transaction so a single bad event does not
+            # discard the rest of the batch.
+            traceback.print_exc()
+            for func, args in batch:
+                try:
+                    with transaction(self.workspace):
+                        func(self.workspace, *args)
+                except Exception:
+                    self.failed_writes += 1
+                    traceback.print_exc()
+        latency = time.perf_counter() - start
+        self.flushed_batches += 1
+        self.flushed_writes += len(batch)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        if self.on_flush is not None:
+            self.on_flush(len(batch), latency, self.depth)